@@ -0,0 +1,306 @@
+"""
+Benchmark suite for the form tag library.
+
+Runs fully offline: Django is configured here with the locmem cache and an
+in-memory SQLite database. Results are printed (or written) as JSON.
+
+Usage:
+    python benchmarks/run.py [--quick] [--output FILE] [--check THRESHOLDS]
+
+With --check, each result is compared against the limits in the given
+threshold file (see thresholds.json) and the exit status is nonzero if any
+limit is exceeded. A limit is either "max_ratio", the highest allowed ratio
+of the benchmark's time to its plain {% for %} baseline, or "max_seconds".
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import django
+from django.conf import settings
+
+settings.configure(
+    INSTALLED_APPS=['formtags'],
+    TEMPLATES=[{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'APP_DIRS': True,
+    }],
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    FORMTAGS_CACHE='default',
+    USE_I18N=False,
+)
+django.setup()
+
+from django import forms
+from django.db import connection, models
+from django.forms.formsets import formset_factory
+from django.template import Context, Template
+
+class Item(models.Model):
+    name = models.CharField(max_length=50)
+
+    class Meta:
+        app_label = 'formtags'
+
+    def __str__(self):
+        return self.name
+
+class ItemForm(forms.Form):
+    choice = forms.ModelChoiceField(queryset=Item.objects.all())
+
+def make_form(fields, choices=0, groups=0):
+    """
+    Make a form class with the given number of char fields and optionally
+    a choice field with the given number of choices, split into groups.
+    """
+    attrs = dict(
+        ('field_{0}'.format(i), forms.CharField())
+        for i in range(fields))
+
+    if choices:
+        options = [(str(i), 'Choice {0}'.format(i)) for i in range(choices)]
+        if groups:
+            size = choices // groups
+            options = [
+                ('Group {0}'.format(g), tuple(options[g * size:(g + 1) * size]))
+                for g in range(groups)
+                ]
+        attrs['choice'] = forms.ChoiceField(choices=options)
+
+    return type('BenchForm', (forms.Form,), attrs)
+
+def template(body):
+    return Template('{% load forms %}' + body)
+
+FIELDS_TPL = template(
+    '{% form form %}'
+    '{% field "field_1*?" %}{{ field.name }}{% endfield %}'
+    '{% field "*_2?" %}{{ field.name }}{% endfield %}'
+    '{% field "<field_5" %}{{ field.name }}{% endfield %}'
+    '{% field %}{{ field.name }}{% endfield %}'
+    '{% endform %}')
+
+FIELDS_BASELINE_TPL = template(
+    '{% for field in form %}{{ field.name }}{% endfor %}')
+
+CHOICES_TPL = template(
+    '{% form form %}'
+    '{% field "choice" %}{% field_choices %}{{ choice.value }}{% endfield_choices %}{% endfield %}'
+    '{% field %}{% endfield %}'
+    '{% endform %}')
+
+CHOICES_BASELINE_TPL = template(
+    '{% for value, label in form.choice.field.choices %}{{ value }}{% endfor %}')
+
+GROUPS_TPL = template(
+    '{% form form %}'
+    '{% field "choice" %}{% field_choice_groups %}{{ optgroup.label }}'
+    '{% field_choices %}{{ choice.value }}{% endfield_choices %}'
+    '{% endfield_choice_groups %}{% endfield %}'
+    '{% field %}{% endfield %}'
+    '{% endform %}')
+
+NESTED_FIELDS_TPL = template(
+    '{% form form %}'
+    '{% field "field_0" %}{{ field.name }}'
+    '{% field "field_1" %}{{ field.name }}{% field "field_2" %}{{ field.name }}{% endfield %}{% endfield %}'
+    '{% endfield %}'
+    '{% field %}{{ field.name }}{% endfield %}'
+    '{% endform %}')
+
+NESTED_FORMS_TPL = template(
+    '{% form form %}{% field %}{{ field.name }}{% endfield %}'
+    '{% form form %}{% field %}{{ field.name }}{% endfield %}'
+    '{% form form %}{% field %}{{ field.name }}{% endfield %}'
+    '{% endform %}{% endform %}{% endform %}')
+
+NESTED_FORMS_BASELINE_TPL = template(
+    '{% for field in form %}{{ field.name }}{% endfor %}'
+    '{% for field in form %}{{ field.name }}{% endfor %}'
+    '{% for field in form %}{{ field.name }}{% endfor %}')
+
+FORMSET_TPL = template(
+    '{% formset formset %}{% field %}{{ field.name }}{% endfield %}{% endformset %}')
+
+FORMSET_FORMS_TPL = template(
+    '{{ formset.management_form }}'
+    '{% for f in formset %}{% form f %}{% field %}{{ field.name }}{% endfield %}{% endform %}{% endfor %}')
+
+FORMSET_BASELINE_TPL = template(
+    '{{ formset.management_form }}'
+    '{% for f in formset %}{% for field in f %}{{ field.name }}{% endfor %}{% endfor %}')
+
+MODEL_CHOICES_TPL = CHOICES_TPL
+
+CACHED_TPL = template(
+    '{% form form %}'
+    '{% field "choice" cache %}{% field_choices %}{{ choice.value }}{% endfield_choices %}{% endfield %}'
+    '{% field %}{% endfield %}'
+    '{% endform %}')
+
+WIDGETS_TPL = template(
+    '{% form form %}{% field %}{{ field|fast_widget }}{% endfield %}{% endform %}')
+
+WIDGETS_BASELINE_TPL = template(
+    '{% for field in form %}{{ field }}{% endfor %}')
+
+def measure(tpl, make_context, repeat):
+    """
+    Return the best render time and the allocation statistics of one render.
+    """
+    tpl.render(make_context())
+
+    best = None
+    for i in range(repeat):
+        context = make_context()
+        gc.collect()
+        start = time.perf_counter()
+        tpl.render(context)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    context = make_context()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tpl.render(context)
+    after = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    allocations = sum(
+        stat.count_diff for stat in after.compare_to(before, 'filename')
+        if stat.count_diff > 0)
+
+    return {
+        'seconds': best,
+        'peak_bytes': peak,
+        'allocations': allocations,
+        }
+
+def benchmarks(quick):
+    """
+    Yield (name, params, template, baseline template, context factory) tuples.
+    """
+    for n in ((10, 100, 1000) if quick else (10, 100, 1000, 10000)):
+        form_class = make_form(n)
+        yield ('fields', {'fields': n}, FIELDS_TPL, FIELDS_BASELINE_TPL,
+            lambda form_class=form_class: Context({'form': form_class()}))
+
+    for n in ((100, 10000) if quick else (100, 10000, 100000)):
+        form_class = make_form(1, choices=n)
+        yield ('choices', {'choices': n}, CHOICES_TPL, CHOICES_BASELINE_TPL,
+            lambda form_class=form_class: Context({'form': form_class()}))
+
+        yield ('cached_choices', {'choices': n}, CACHED_TPL, CHOICES_BASELINE_TPL,
+            lambda form_class=form_class: Context({'form': form_class()}))
+
+        form_class = make_form(1, choices=n, groups=100)
+        yield ('grouped_choices', {'choices': n, 'groups': 100}, GROUPS_TPL, None,
+            lambda form_class=form_class: Context({'form': form_class()}))
+
+    form_class = make_form(100)
+    yield ('nested_fields', {'fields': 100}, NESTED_FIELDS_TPL, FIELDS_BASELINE_TPL,
+        lambda: Context({'form': form_class()}))
+
+    yield ('nested_forms', {'fields': 100, 'depth': 3}, NESTED_FORMS_TPL, NESTED_FORMS_BASELINE_TPL,
+        lambda: Context({'form': form_class()}))
+
+    for rows in ((10, 100) if quick else (10, 100, 300)):
+        formset_class = formset_factory(make_form(10), extra=rows)
+        yield ('formset', {'rows': rows, 'fields': 10}, FORMSET_TPL, FORMSET_BASELINE_TPL,
+            lambda formset_class=formset_class: Context({'formset': formset_class()}))
+
+        yield ('formset_forms', {'rows': rows, 'fields': 10}, FORMSET_FORMS_TPL, FORMSET_BASELINE_TPL,
+            lambda formset_class=formset_class: Context({'formset': formset_class()}))
+
+    for n in ((10, 100) if quick else (10, 100, 1000)):
+        form_class = make_form(n, choices=10)
+        yield ('fast_widgets', {'fields': n}, WIDGETS_TPL, WIDGETS_BASELINE_TPL,
+            lambda form_class=form_class: Context({'form': form_class()}))
+
+    for n in ((100,) if quick else (100, 1000)):
+        yield ('model_choices', {'choices': n}, MODEL_CHOICES_TPL, None,
+            lambda n=n: _with_items(n, ItemForm))
+
+def _with_items(n, form_class):
+    if Item.objects.count() != n:
+        Item.objects.all().delete()
+        Item.objects.bulk_create([Item(name='Item {0}'.format(i)) for i in range(n)])
+    return Context({'form': form_class()})
+
+def run(quick, repeat):
+    with connection.schema_editor() as editor:
+        editor.create_model(Item)
+
+    results = []
+    for name, params, tpl, baseline, make_context in benchmarks(quick):
+        result = {'name': name, 'params': params}
+        result.update(measure(tpl, make_context, repeat))
+        if baseline is not None:
+            result['baseline_seconds'] = measure(baseline, make_context, repeat)['seconds']
+            result['ratio'] = result['seconds'] / result['baseline_seconds']
+        results.append(result)
+
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'quick': quick,
+        'repeat': repeat,
+        'results': results,
+        }
+
+def check(report, thresholds):
+    """
+    Return a list of threshold violations.
+    """
+    failures = []
+    for result in report['results']:
+        limits = thresholds.get(result['name'])
+        if not limits:
+            continue
+
+        label = '{0} {1}'.format(result['name'], json.dumps(result['params'], sort_keys=True))
+        if 'max_ratio' in limits and 'ratio' in result and result['ratio'] > limits['max_ratio']:
+            failures.append('{0}: ratio {1:.2f} > {2}'.format(label, result['ratio'], limits['max_ratio']))
+        if 'max_seconds' in limits and result['seconds'] > limits['max_seconds']:
+            failures.append('{0}: {1:.4f}s > {2}s'.format(label, result['seconds'], limits['max_seconds']))
+
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--quick', action='store_true', help='use smaller sizes')
+    parser.add_argument('--repeat', type=int, default=5, help='timing repetitions')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    parser.add_argument('--check', metavar='THRESHOLDS', help='check results against a threshold file')
+    args = parser.parse_args()
+
+    report = run(args.quick, args.repeat)
+
+    if args.check:
+        with open(args.check) as f:
+            report['failures'] = check(report, json.load(f))
+
+    out = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out)
+    else:
+        print(out)
+
+    if report.get('failures'):
+        for failure in report['failures']:
+            sys.stderr.write('REGRESSION: {0}\n'.format(failure))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+"""
+Jinja2 extension implementing the form tag library.
+
+Usage:
+    env = jinja2.Environment(extensions=['formtags.jinja.FormtagsExtension'])
+
+The extension provides the same tags as the Django tag library (form, field,
+if_field, field_choices, field_choice_groups and hidden_fields) and the
+widget_name and fast_widget filters, with the same matcher semantics and
+precedence:
+
+    {% form form %}
+    {% field "title" %}...{% endfield %}
+    {% field "*_date", "*_time" %}...{% endfield %}
+    {% field %}{{ field }}{% endfield %}
+    {% hidden_fields %}
+    {% endform %}
+
+Note that multiple matchers must be separated by commas, as Jinja2
+concatenates adjacent string literals.
+
+The matching and assignment core is shared with the Django tag library.
+Unlike the Django form tag, the gathering pass renders the whole form body
+(discarding the output), as compiled Jinja2 templates cannot be walked
+structurally.
+
+The formset tag and the cache and using options of the Django tags are not
+supported.
+"""
+import threading
+
+from jinja2 import is_undefined, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from .templatetags.forms import FormTagError, _LRUCache, \
+        _RenderState, _assign_planned, _get_matcher, _choice_table, \
+        _field_selection, _value_key, widget_name, fast_widget
+
+# Maximum number of assignment plans kept per environment. Plans depend only
+# on the form's visible fields and the registered matchers, so they are
+# shared by all the form tags of the environment's templates.
+SHARED_PLAN_CACHE_SIZE = 1024
+
+def _is_field_tag(node):
+    return (
+        isinstance(node, nodes.CallBlock)
+        and isinstance(node.call.node, nodes.ExtensionAttribute)
+        and node.call.node.name == '_field'
+        )
+
+def _has_field_tags(body):
+    """
+    Return true if the parsed body contains field tags.
+    """
+    for node in body:
+        if _is_field_tag(node):
+            return True
+        if any(_is_field_tag(n) for n in node.find_all(nodes.CallBlock)):
+            return True
+    return False
+
+class _Frame(object):
+    """
+    Rendering state of a form tag.
+    """
+    __slots__ = ('form', 'state', 'field', 'group')
+
+    def __init__(self, form):
+        self.form = form
+        self.state = _RenderState()
+        self.field = None
+        self.group = None
+
+class FormtagsExtension(Extension):
+    """
+    Jinja2 extension providing the form tags.
+    """
+    tags = set(['form', 'field', 'if_field', 'field_choices', 'field_choice_groups', 'hidden_fields'])
+
+    def __init__(self, environment):
+        super(FormtagsExtension, self).__init__(environment)
+        environment.filters['widget_name'] = widget_name
+        environment.filters['fast_widget'] = fast_widget
+        self._local = threading.local()
+        self._plans = _LRUCache(SHARED_PLAN_CACHE_SIZE)
+
+    # Parsing
+
+    def parse(self, parser):
+        token = next(parser.stream)
+        return getattr(self, '_parse_' + token.value)(parser, token.lineno)
+
+    def _parse_form(self, parser, lineno):
+        form = parser.parse_expression()
+        body = parser.parse_statements(('name:endform',), drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method('_form', [form]), [], [], body).set_lineno(lineno)
+
+    def _parse_field(self, parser, lineno):
+        matchers = []
+        fieldvar = 'field'
+        while parser.stream.current.type != 'block_end':
+            if parser.stream.skip_if('name:as'):
+                fieldvar = parser.stream.expect('name').value
+                break
+            matchers.append(parser.parse_expression())
+            parser.stream.skip_if('comma')
+
+        body = parser.parse_statements(('name:endfield',), drop_needle=True)
+        dynamic = not all(isinstance(m, nodes.Const) for m in matchers)
+        return nodes.CallBlock(
+            self.call_method('_field', [
+                nodes.List(matchers), nodes.Const(dynamic), nodes.Const(_has_field_tags(body))]),
+            [nodes.Name(fieldvar, 'param')], [], body).set_lineno(lineno)
+
+    def _parse_if_field(self, parser, lineno):
+        matchers = []
+        while parser.stream.current.type != 'block_end':
+            matchers.append(parser.parse_expression())
+            parser.stream.skip_if('comma')
+
+        body = parser.parse_statements(('name:else', 'name:endif_field'))
+        else_ = []
+        if next(parser.stream).value == 'else':
+            else_ = parser.parse_statements(('name:endif_field',), drop_needle=True)
+
+        return nodes.If(
+            self.call_method('_if_field', [nodes.List(matchers)]),
+            body, [], else_).set_lineno(lineno)
+
+    def _parse_field_choices(self, parser, lineno):
+        choicevar = 'choice'
+        if parser.stream.skip_if('name:as'):
+            choicevar = parser.stream.expect('name').value
+
+        body = parser.parse_statements(('name:empty', 'name:endfield_choices'))
+        empty = []
+        if next(parser.stream).value == 'empty':
+            empty = parser.parse_statements(('name:endfield_choices',), drop_needle=True)
+
+        result = [nodes.CallBlock(
+            self.call_method('_field_choices'),
+            [nodes.Name(choicevar, 'param')], [], body).set_lineno(lineno)]
+        if empty:
+            result.append(nodes.If(
+                self.call_method('_no_choices'), empty, [], []).set_lineno(lineno))
+        return result
+
+    def _parse_field_choice_groups(self, parser, lineno):
+        groupvar = 'optgroup'
+        if parser.stream.skip_if('name:as'):
+            groupvar = parser.stream.expect('name').value
+
+        body = parser.parse_statements(('name:endfield_choice_groups',), drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method('_field_choice_groups'),
+            [nodes.Name(groupvar, 'param')], [], body).set_lineno(lineno)
+
+    def _parse_hidden_fields(self, parser, lineno):
+        return nodes.Output([self.call_method('_hidden_fields')]).set_lineno(lineno)
+
+    # Rendering
+
+    def _frames(self):
+        try:
+            return self._local.frames
+        except AttributeError:
+            frames = self._local.frames = []
+            return frames
+
+    def _frame(self, tag):
+        frames = self._frames()
+        if not frames:
+            raise FormTagError("{0} tag must be nested in a form tag!".format(tag))
+        return frames[-1]
+
+    def _form(self, form, caller):
+        if form is None or is_undefined(form):
+            # Like the Django tag, a missing form renders nothing
+            return u''
+
+        frames = self._frames()
+        if frames and not frames[-1].state.render:
+            # Nested forms are not rendered in the gathering pass
+            # of the enclosing form.
+            return u''
+
+        frame = _Frame(form)
+        frames.append(frame)
+        try:
+            # Gather fields
+            caller()
+
+            # Assign fields to tags, taking matcher precedence in account
+            _assign_planned(self._plans, form, frame.state)
+
+            # Render
+            frame.state.render = True
+            return caller()
+
+        finally:
+            frames.pop()
+
+    def _field(self, matchers, dynamic, has_nested, caller):
+        frame = self._frame('Field')
+        state = frame.state
+
+        if not state.render:
+            state.tags.append([_get_matcher(m) for m in matchers or ('',)])
+            if dynamic:
+                state.dynamic = True
+
+            # If nested fields are present, they must register themselves as well
+            if has_nested:
+                caller(None)
+            return u''
+
+        fields = state.fields[state.cursor]
+        state.cursor += 1
+
+        parent = frame.field
+        out = []
+        try:
+            for f in fields:
+                frame.field = f
+                out.append(caller(f))
+        finally:
+            frame.field = parent
+
+        return u'\n'.join(out)
+
+    def _if_field(self, matchers):
+        state = self._frame('If_field').state
+        if not state.render:
+            return False
+
+        if not matchers:
+            matchers = ['']
+        return any(m in state.matches for m in matchers)
+
+    def _choice_range(self, frame):
+        table = _choice_table(frame.state, frame.field)
+        if frame.group is not None:
+            start, end = frame.group['_range']
+        else:
+            start, end = 0, len(table.values)
+        return table, start, end
+
+    def _field_choices(self, caller):
+        frame = self._frame('Field_choices')
+        if not frame.state.render:
+            return u''
+
+        field = frame.field
+        selected_values = _field_selection(field)
+        table, start, end = self._choice_range(frame)
+
+        out = []
+        auto_id = field.auto_id
+        for idx in range(start, end):
+            value = table.values[idx]
+            selected = _value_key(value) in selected_values
+            out.append(caller({
+                'value': value,
+                'label': table.labels[idx],
+                'selected': selected,
+                'checked': 'checked=checked' if selected else '',
+                'index': idx,
+                'id': auto_id + table.suffixes[idx],
+                }))
+
+        return u''.join(out)
+
+    def _no_choices(self):
+        frame = self._frame('Field_choices')
+        if not frame.state.render:
+            return False
+
+        table, start, end = self._choice_range(frame)
+        return start >= end
+
+    def _field_choice_groups(self, caller):
+        frame = self._frame('Field_choice_groups')
+        if not frame.state.render:
+            return u''
+
+        groups = [
+            {
+                'label': label,
+                'index': idx,
+                'choices': choices,
+                '_range': (start, end),
+            }
+            for idx, (label, start, end, choices) in enumerate(_choice_table(frame.state, frame.field).groups)
+            ]
+
+        if not groups:
+            groups.append({
+                'label': '',
+                'index': 0,
+                'choices': (),
+                '_range': (0, 0),
+                })
+
+        out = []
+        parent = frame.group
+        try:
+            for group in groups:
+                frame.group = group
+                out.append(caller(group))
+        finally:
+            frame.group = parent
+
+        return u'\n'.join(out)
+
+    def _hidden_fields(self):
+        frame = self._frame('Hidden field')
+        if not frame.state.render:
+            return u''
+
+        return Markup(u'\n'.join([str(f) for f in frame.form.hidden_fields()]))
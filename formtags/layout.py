@@ -0,0 +1,113 @@
+"""
+Python layout API using the matching and assignment core of the form tag
+library, without the template engine.
+
+Usage:
+    layout = Layout([
+        ("title", render_title),
+        ("*_date", render_date),
+        (("address_*", "zip"), render_address),
+        (None, render_default),
+        ])
+
+    html = layout.render(form)
+
+A layout is a list of (matchers, renderer) rules, corresponding to field tags
+in a template: the matchers are a matcher definition string (as used by the
+field tag), a tuple of them, or None for the catch-all. The renderer is a
+callable taking a bound field and returning its markup. The fields are
+assigned to the rules with the same precedence semantics as field tags, and
+rendered in the order of the rules.
+
+The output of the renderers is escaped unless it is marked safe (as with
+format_html). The outputs are joined with the separator, a newline by
+default. The form's hidden fields are rendered after the rules, unless
+hidden_fields is False.
+"""
+import time
+
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+
+from .signals import form_rendered
+from .templatetags.forms import FormTagError, PLAN_CACHE_SIZE, _LRUCache, \
+        _RenderState, RenderStats, _assign_planned, _count_assigned, parse_matcher
+
+class Layout(object):
+    """
+    A compiled list of field rendering rules.
+
+    The matchers are parsed when the layout is created, and field
+    assignments are planned once per form class and reused.
+    """
+
+    def __init__(self, rules, separator=u'\n', hidden_fields=True):
+        """
+        Arguments:
+        rules         -- list of (matchers, renderer) tuples
+        separator     -- string to join the rendered fields with
+        hidden_fields -- render the form's hidden fields after the rules
+        """
+        self.tags = []
+        self.renderers = []
+        for matchers, renderer in rules:
+            if matchers is None:
+                matchers = ('',)
+            elif isinstance(matchers, str):
+                matchers = (matchers,)
+            if not callable(renderer):
+                raise FormTagError("Renderer for {0!r} is not callable".format(matchers))
+
+            self.tags.append([parse_matcher(m) for m in matchers])
+            self.renderers.append(renderer)
+
+        self.separator = separator
+        self.hidden_fields = hidden_fields
+        self._plans = _LRUCache(PLAN_CACHE_SIZE)
+
+    def assign(self, form):
+        """
+        Return a list of (renderer, fields) tuples for the form, in the
+        order of the rules.
+        """
+        state = self._assign(form)
+        return list(zip(self.renderers, state.fields))
+
+    def render(self, form):
+        """
+        Render the form.
+        """
+        stats = RenderStats() if form_rendered.receivers else None
+
+        start = time.perf_counter()
+        state = self._assign(form, stats)
+        if stats is not None:
+            stats.assign_time = time.perf_counter() - start
+            _count_assigned(state)
+            start = time.perf_counter()
+
+        out = [
+            conditional_escape(renderer(f))
+            for (renderer, fields) in zip(self.renderers, state.fields)
+            for f in fields
+            ]
+        if self.hidden_fields:
+            out.extend(str(f) for f in form.hidden_fields())
+        html = mark_safe(self.separator.join(out))
+
+        if stats is not None:
+            stats.render_time = time.perf_counter() - start
+            form_rendered.send(sender=type(self), node=self, form=form, stats=stats)
+
+        return html
+
+    def _assign(self, form, stats=None):
+        state = _RenderState()
+        state.tags = self.tags
+        state.stats = stats
+        _assign_planned(self._plans, form, state)
+        return state
+
+    def __repr__(self):
+        return '<Layout: {0}>'.format(
+            '; '.join(', '.join(repr(m) for m in matchers) for matchers in self.tags))
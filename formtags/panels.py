@@ -0,0 +1,59 @@
+"""
+Panel for django-debug-toolbar showing form rendering statistics.
+
+Add "formtags.panels.FormtagsPanel" to DEBUG_TOOLBAR_PANELS to enable it.
+"""
+import threading
+
+from debug_toolbar.panels import Panel
+
+from .signals import form_rendered
+
+class FormtagsPanel(Panel):
+    """
+    Aggregates the form_rendered statistics of a request.
+    """
+    title = 'Formtags'
+    template = 'formtags/panel.html'
+
+    def __init__(self, *args, **kwargs):
+        super(FormtagsPanel, self).__init__(*args, **kwargs)
+        self._forms = []
+        self._thread = None
+
+    @property
+    def nav_subtitle(self):
+        return '{0} forms in {1:.2f} ms'.format(
+            len(self._forms), sum(f['total_time'] for f in self._forms))
+
+    def enable_instrumentation(self):
+        self._thread = threading.current_thread()
+        form_rendered.connect(self._record)
+
+    def disable_instrumentation(self):
+        form_rendered.disconnect(self._record)
+
+    def _record(self, sender, node, form, stats, **kwargs):
+        # Receivers are global: ignore forms rendered by other requests
+        if threading.current_thread() is not self._thread:
+            return
+
+        record = stats.as_dict()
+        for key in ('gather_time', 'assign_time', 'render_time'):
+            record[key] *= 1000.0
+        record['total_time'] = record['gather_time'] + record['assign_time'] + record['render_time']
+        record['node'] = repr(node)
+        record['form'] = type(form).__name__
+        self._forms.append(record)
+
+    def generate_stats(self, request, response):
+        totals = {}
+        for record in self._forms:
+            for key, value in record.items():
+                if isinstance(value, (int, float)):
+                    totals[key] = totals.get(key, 0) + value
+
+        self.record_stats({
+            'forms': self._forms,
+            'totals': totals,
+            })
@@ -0,0 +1,15 @@
+"""
+Signals sent by the form tag library.
+"""
+from django.dispatch import Signal
+
+# Sent after a form or formset tag has been rendered.
+#
+# Arguments:
+# sender -- the node class
+# node   -- the node instance
+# form   -- the form (or formset) that was rendered
+# stats  -- a RenderStats instance
+#
+# Statistics are collected only while receivers are connected.
+form_rendered = Signal()
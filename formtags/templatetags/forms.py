@@ -4,15 +4,18 @@ Version 1.3
 Copyright 2013 Sofokus Oy. Licensed under the MIT license.
 ---
 
-This library introduces five new tags and one filter:
+This library introduces the following tags and filter:
 
-    {% form name %} ... {% endform %}
-    {% field ["matcher"...] [as field] %} ... {% endfield %}
+    {% form name [using "form.Class"] [cache] %} ... {% endform %}
+    {% formset name [as form] [empty_form] %} ... {% endformset %}
+    {% field ["matcher"...] [cache] [as field] %} ... {% endfield %}
     {% if_field ["matcher"] %}...{% else %}...{% endfield %}
     {% field_choices [as choice] %}...{% empty %}...{% endfield_choices %}
     {% field_choice_groups [as optgroup] %}...{% endfield_choice_groups %}
     {% hidden_fields %}
+    {% field_switch [field] [mro] %}{% case "Widget1 Widget2" %}...{% default %}...{% endfield_switch %}
     {{ field|widget_name }}
+    {{ field|fast_widget }}
 
 The form tag defines the scope for the form fields. The first
 parameter is the context variable containing the Django form.
@@ -67,6 +70,80 @@ render grouped choice fields:
     {% endfield_choice_groups %}
     {% endfield %}
     
+If a template always renders the same form class, the class can be given
+with the "using" option:
+
+    {% form form using "myapp.forms.SignupForm" %}...{% endform %}
+
+The field assignment is then computed when the template is compiled, and
+matching errors (missing required fields, left over fields) are reported at
+load time. At render time, the precomputed assignment is used directly if the
+form is an instance of the class with the same visible fields; otherwise the
+fields are gathered and assigned normally. The field tags of such a form must
+use string literal matchers and may not be enclosed in other tags.
+
+To render a formset, use the formset tag instead of a form tag. Its content
+is rendered once for each form of the formset, with the current form
+available as "form" (or the name given with "as"). The management form is
+rendered automatically. If the "empty_form" option is given, the formset's
+empty form is rendered last.
+
+    {% formset formset %}
+    <div class="row">
+    {% field %}{{ field }}{% endfield %}
+    {% hidden_fields %}
+    </div>
+    {% endformset %}
+
+The field tags are gathered and assigned only once for the whole formset, so
+the field tags to run must not depend on the individual form.
+
+The output of a field tag can be cached with the "cache" option:
+
+    {% field "country" cache %}
+    {% field_choices %}...{% endfield_choices %}
+    {% endfield %}
+
+The output is cached per field, keyed by the form class, the field's class,
+name, ID, label, help text and label suffix, its required, disabled,
+show_hidden_initial and localize flags, widget class and attributes,
+choices, value and errors, the active language and the location of the tag.
+The content of the tag must not depend on anything else, and it may not
+contain nested field tags. Fields with lazy choices (such as the queryset of
+a model choice field) are never cached. By default, a bounded in-process
+cache is used. Set FORMTAGS_CACHE to the name of a configured Django cache to
+use it instead.
+
+The whole output of a form tag can be cached likewise:
+
+    {% form form cache %}...{% endform %}
+
+Only unbound forms without errors are cached. The cache key consists of the
+form class, prefix and auto_id, the same identity of each field as for field
+tags (with callable initial values evaluated), the active language and the
+location of the tag. Forms with fields with lazy choices are never cached. A
+CSRF token rendered inside the form is substituted with the current token
+whenever cached output is served.
+
+Prefetching choices:
+
+Lazy choices, such as the querysets of model choice fields, are normally
+evaluated one by one as the fields are rendered. If the FORMTAGS_PREFETCH_THREADS
+setting is set, the lazy choices of the fields rendered with field_choices or
+field_choice_groups tags are evaluated concurrently on a pool of that many
+threads, after the fields are assigned and before the form is rendered.
+Each thread uses its own database connections, and the active language and
+time zone of the rendering thread. Choices are not prefetched inside a
+transaction.
+
+Instrumentation:
+
+After each form or formset tag is rendered, the formtags.signals.form_rendered
+signal is sent with the timings of the rendering passes and counts of fields,
+tags, matcher evaluations and rendered choices. The statistics are collected
+only when a receiver is connected. For django-debug-toolbar, a panel is
+available as formtags.panels.FormtagsPanel.
+
 Of course, the real power of this tag library is in the field matchers.
 
 This example renders the field named "title" first, followed by the rest of
@@ -80,9 +157,14 @@ More specific field matchers have precedence over more general matchers, so
 in the above example the uniquely identifying matcher "title" could have
 come after the catch-all field tag. This is accomplished by rendering the form
 in two passes: During the first pass the field tags sort themselves according
-to their precedence and grab all the fields they can. Any output generated
-during the first pass is discarded. The second pass is when the fields, now
-knowing their proper order, actually render their contents.
+to their precedence and grab all the fields they can. Only the field tags
+and the tags enclosing them are visited during the first pass: {% if %} and
+{% with %} are evaluated without rendering, other enclosing tags (such as
+{% for %}) and tags that may load field tags from other templates (such as
+{% include %} and {% block %}) are rendered and their output discarded. Nested form tags are
+skipped in the first pass, as they render their own fields. The second pass
+is when the fields, now knowing their proper order, actually render their
+contents.
 
 Field tags may also be nested. For example:
     {% form %}
@@ -110,6 +192,35 @@ to low):
                     fields are matched, an error is generated.
     "name*?"    --  Like above, but no error is generated even if no field
                     matches.
+    "na*me"     --  Match all fields matching the given glob pattern. The
+    "na?me"         wildcard * matches any substring and ? any single
+                    character. Both may appear anywhere, any number of times,
+                    except that a trailing ? always marks the matcher as
+                    optional (see below): "address_*_line?" is the optional
+                    pattern "address_*_line", to end a pattern with a single
+                    character wildcard write "address_*_line??". If no fields
+                    are matched, an error is generated.
+    "re:regex"  --  Match all fields whose whole name matches the given
+                    regular expression. If no fields are matched, an error
+                    is generated.
+    "na*me?"    --  Like above, but no error is generated even if no field
+                    matches.
+    "re?:regex" --  Like above, but no error is generated even if no field
+                    matches.
+    "widget:Class"
+                --  Match all fields whose widget class has the given name.
+                    If no fields are matched, an error is generated.
+    "type:Class"
+                --  Match all fields whose form field class has the given
+                    name. If no fields are matched, an error is generated.
+    "is:required"
+    "is:hidden-initial"
+                --  Match all required fields, or all fields rendered with a
+                    hidden initial value. If no fields are matched, an error
+                    is generated.
+    "widget:Class?", "type:Class?", "is:flag?"
+                --  Like above, but no error is generated even if no field
+                    matches.
     "<name"     --  Match all fields that come before "name".
     "<=name"    --  Match "name" and all fields that come before it.
     ">name"     --  Match all fields that come after "name".
@@ -143,11 +254,102 @@ Example:
     ...
     {% endif %}
 
+When choosing between several widget types, the field_switch tag is more
+efficient, as the block is looked up by widget class instead of testing each
+name in turn:
+
+    {% field_switch %}
+    {% case "Textarea MyBigWidget" %}
+    ...
+    {% case "Select" "SelectMultiple" %}
+    ...
+    {% default %}
+    ...
+    {% endfield_switch %}
+
+The field defaults to the current field of the enclosing field tag, in which
+case the blocks may not contain field tags. With the "mro" option, the names of the widget's base classes are matched as well, so
+a case for "Select" also matches subclasses of Select.
+
+    {{ field|fast_widget }}
+
+The fast_widget filter renders the field like {{ field }}, but the common
+built-in widgets (text-like inputs, checkboxes, textareas and selects) are
+rendered directly in Python instead of through the widget templates. The
+output is identical to Django's. Other widgets, subclasses of the built-in
+widgets and widgets whose templates are overridden are rendered normally.
+
+Streaming output:
+
+Large forms can be rendered in chunks with the stream_template function,
+whose output can be passed directly to a StreamingHttpResponse:
+
+    return StreamingHttpResponse(stream_template(tpl, {'form': form}, request))
+
+Rendering a single field:
+
+To re-render one field of a form (e.g. for inline validation), use the
+render_form_fragment function:
+
+    html = render_form_fragment(tpl, form, 'email', request=request)
+
+The fields are assigned to the field tags of the template's form tag as in a
+full render, but only the field tag rendering the named field is rendered,
+for that field alone. If the field tag is nested in other field tags, the
+outermost enclosing field tag is rendered, with its other nested field tags
+left empty. Variables set by other tags around the field tag are not
+available.
+
+For forms that are edited live, only the changed parts of a previous render
+can be re-rendered. render_form_map renders the template like a full render
+and returns a RenderMap: the output together with the span of the output
+of each field. render_form_patches takes a previous RenderMap and returns a
+list of (start, end, html) patches to the previous output, for the fields
+in form.changed_data and the fields whose errors changed, together with the
+RenderMap of the patched output:
+
+    previous = render_form_map(tpl, form, request=request)
+    ...
+    patches, previous = render_form_patches(tpl, form, previous, request=request)
+
+The span of a field nested in other field tags is that of the outermost
+enclosing field tag. Fields rendered outside field tags (such as hidden
+fields) are not patched.
 
 """
 
-from collections import deque
+from bisect import bisect_left
+from collections import OrderedDict
+from operator import lt, le, gt, ge
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+import hashlib
+import os
+import re
+import threading
+import time
+import uuid
+import weakref
+
 from django import template
+from django import forms
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections, connections
+from django.forms.renderers import DjangoTemplates
+from django.utils.formats import localize
+from django.utils.html import conditional_escape
+from django.utils.module_loading import import_string
+from django.utils.safestring import SafeData, mark_safe
+from django.utils import timezone, translation
+from django.utils.timezone import template_localtime
+from django.utils.translation import get_language
+
+from ..signals import form_rendered
+from django.template.base import TextNode
+from django.template.context import make_context
+from django.template.defaulttags import IfNode, WithNode
+from django.template.loader_tags import BlockNode, ExtendsNode, IncludeNode
 
 register = template.Library()
 
@@ -162,19 +364,71 @@ CURFIELDVAR = "__FORMS_FIELD"
 # The current option group. Used by field_choices and field_choice_groups tags.
 OPTGROUPVAR = "__FORMS_OPTGROUP"
 
-# Form rendering state.
+# Form rendering state (a _RenderState instance).
 STATEVAR = "__FORMS_STATE"
 
+# Maximum number of parsed matchers kept for runtime matcher strings
+MATCHER_CACHE_SIZE = 256
+
+# Maximum number of combined expressions kept for sets of pattern matchers
+PATTERN_CACHE_SIZE = 64
+
+# The span markers of the form node mapped by render_form_map
+MAPVAR = "__FORMS_MAP"
+
+# Maximum number of rendered fragments kept in the in-process cache
+FRAGMENT_CACHE_SIZE = 1000
+
 class FormTagError(template.TemplateSyntaxError):
     pass
 
+class _LRUCache(object):
+    """
+    A bounded mapping that discards the least recently used entries.
+    Safe to share between threads.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
 class FieldMatcher(object):
     """
     Base class for field matchers.
+
+    The precedence attribute is used during field assignment: field tags
+    will greedily grab all the form fields they can in the order of their
+    precedence. Lower number means higher precedence.
     """
+    __slots__ = ('definition_string', 'precedence')
 
-    def __init__(self, defstr):
+    def __init__(self, defstr, precedence):
         self.definition_string = defstr
+        self.precedence = precedence
 
     def match(self, field, field_order):
         """
@@ -186,6 +440,18 @@ class FieldMatcher(object):
         """
         raise NotImplementedError("Matcher not implemented!")
 
+    def select(self, index):
+        """
+        Return the indices of all fields matched by this object.
+
+        The default implementation tests each field with match().
+        Subclasses should use the lookup structures of the index instead.
+
+        Arguments
+        index       --  a FieldIndex of the form's visible fields
+        """
+        return [i for (i, f) in enumerate(index.fields) if self.match(f, index.order)]
+
     def is_required(self):
         """
         Return true if it is an error if this matcher does not match any
@@ -197,14 +463,6 @@ class FieldMatcher(object):
         """
         return True
 
-    def precedence(self):
-        """
-        During field assignment, field tags will greedily grab all the
-        form fields they can in the order of their precedence. Lower number
-        means higher precedence.
-        """
-        raise NotImplementedError("No precedence given for field!")
-
     def __repr__(self):
         return '{0}({1})'.format(type(self).__name__, self.definition_string)
 
@@ -212,19 +470,20 @@ class AnyMatcher(FieldMatcher):
     """
     A matcher that matches any field.
     """
+    __slots__ = ()
 
     def __init__(self):
-        super(AnyMatcher, self).__init__('')
+        super(AnyMatcher, self).__init__('', 99)
 
     def match(self, field, field_order):
         return True
 
+    def select(self, index):
+        return range(len(index.fields))
+
     def is_required(self):
         return False
 
-    def precedence(self):
-        return 99
-
 class NameMatcher(FieldMatcher):
     """
     A matcher that matches fields by name.
@@ -235,20 +494,26 @@ class NameMatcher(FieldMatcher):
     name matches the end of the field name.
     A wildcard matcher has lower precedence than a non-wildcard name matcher.
     """
-    def __init__(self, name):
-        super(NameMatcher, self).__init__(name)
+    __slots__ = ('wildcard', 'endswith', 'name')
 
+    def __init__(self, name, precedence_offset=0):
         if name[-1] == '*':
             self.wildcard = True
             self.endswith = False
             self.name = name[:-1]
+            precedence = 11
         elif name[0] == '*':
             self.wildcard = True
             self.endswith = True
             self.name = name[1:]
+            precedence = 10
         else:
             self.wildcard = False
+            self.endswith = False
             self.name = name
+            precedence = 0
+
+        super(NameMatcher, self).__init__(name, precedence + precedence_offset)
 
     def match(self, field, field_order):
         if self.wildcard:
@@ -259,10 +524,14 @@ class NameMatcher(FieldMatcher):
         else:
             return field.name == self.name
 
-    def precedence(self):
+    def select(self, index):
         if self.wildcard:
-            return 10 if self.endswith else 11
-        return 0
+            if self.endswith:
+                return index.suffixed(self.name)
+            else:
+                return index.prefixed(self.name)
+        else:
+            return index.exact(self.name)
 
 class OptionalNameMatcher(NameMatcher):
     """
@@ -270,12 +539,15 @@ class OptionalNameMatcher(NameMatcher):
     
     An optional name matcher has lower precendence than
     a required one."""
+    __slots__ = ()
+
+    def __init__(self, name):
+        super(OptionalNameMatcher, self).__init__(name, 2)
 
     def is_required(self):
         return False
 
-    def precedence(self):
-        return super(OptionalNameMatcher, self).precedence() + 2
+_RELATIVE_OPERATORS = {'<': lt, '<=': le, '>': gt, '>=': ge}
 
 class RelativeMatcher(FieldMatcher):
     """
@@ -286,19 +558,16 @@ class RelativeMatcher(FieldMatcher):
     <= - match the operand and all fields before it
     >= - match the operand and all fields after it
     """
+    __slots__ = ('operand', 'op', 'operator')
+
     def __init__(self, operator, operand):
-        super(RelativeMatcher, self).__init__(operator + operand)
+        super(RelativeMatcher, self).__init__(
+            operator + operand, 50 if operator[0] == '<' else 60)
         self.operand = operand
         self.op = operator
-        if operator == '<':
-            self.operator = lambda x, y: x < y
-        elif operator == '<=':
-            self.operator = lambda x, y: x <= y
-        elif operator == '>':
-            self.operator = lambda x, y: x > y
-        elif operator == '>=':
-            self.operator = lambda x, y: x >= y
-        else:
+        try:
+            self.operator = _RELATIVE_OPERATORS[operator]
+        except KeyError:
             raise FormTagError("Unknown operator: {0}".format(operator))
 
     def match(self, field, field_order):
@@ -307,16 +576,563 @@ class RelativeMatcher(FieldMatcher):
         except KeyError:
             raise FormTagError("No such field: {0}".format(self.operand))
 
+    def select(self, index):
+        try:
+            pos = index.order[self.operand]
+        except KeyError:
+            raise FormTagError("No such field: {0}".format(self.operand))
+
+        if self.op == '<':
+            return range(0, pos)
+        elif self.op == '<=':
+            return range(0, pos + 1)
+        elif self.op == '>':
+            return range(pos + 1, len(index.fields))
+        else:
+            return range(pos, len(index.fields))
+
     def is_required(self):
         return False
 
-    def precedence(self):
-        return 50 if self.op[0] == '<' else 60
+class PatternMatcher(FieldMatcher):
+    """
+    A matcher that matches field names against a glob pattern or a regular
+    expression.
+
+    In a glob pattern, * matches any substring and ? any single character.
+    A regular expression must match the whole field name. Glob matchers have
+    precedence over regular expression matchers, and optional pattern
+    matchers have lower precedence than required ones.
+
+    During field assignment, all the pattern matchers of a form are
+    combined into a single expression, so each field name is classified
+    in one scan. See FieldIndex.classify.
+    """
+    __slots__ = ('kind', 'regex', 'optional')
+
+    def __init__(self, kind, pattern, optional=False):
+        if kind == 'glob':
+            defstr = pattern
+            regex = '.*'.join(
+                '.'.join(re.escape(chars) for chars in part.split('?'))
+                for part in pattern.split('*'))
+            precedence = 14
+        else:
+            defstr = 're:' + pattern
+            regex = pattern
+            precedence = 15
+
+        super(PatternMatcher, self).__init__(defstr, precedence + (2 if optional else 0))
+        try:
+            self.regex = re.compile(regex)
+        except re.error as e:
+            raise FormTagError("Invalid pattern {0!r}: {1}".format(pattern, e))
+        self.kind = kind
+        self.optional = optional
+
+    def match(self, field, field_order):
+        return self.regex.fullmatch(field.name) is not None
+
+    def select(self, index):
+        return index.pattern(self)
+
+    def is_required(self):
+        return not self.optional
+
+# Regular expression features that prevent an expression from being
+# combined with others: numbered and named backreferences
+_BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+_pattern_cache = _LRUCache(PATTERN_CACHE_SIZE)
+
+def _combine_patterns(matchers):
+    """
+    Combine the expressions of pattern matchers into a single expression.
+
+    Returns a tuple of the compiled expression and a map of group numbers
+    to positions in the matcher list, or None if the expressions cannot be
+    combined. Matchers whose expressions use backreferences are left out.
+
+    Arguments:
+    matchers -- list of pattern matchers, in the order of precedence
+    """
+    key = tuple(m.regex.pattern for m in matchers)
+    combined = _pattern_cache.get(key)
+    if combined is not None:
+        return combined or None
+
+    alternatives = []
+    groups = {}
+    group = 1
+    for pos, m in enumerate(matchers):
+        if _BACKREFERENCE.search(m.regex.pattern):
+            continue
+        alternatives.append('(' + m.regex.pattern + ')')
+        groups[group] = pos
+        group += 1 + m.regex.groups
+
+    try:
+        combined = (re.compile('|'.join(alternatives)), groups)
+    except re.error:
+        # E.g. the same group name is used in more than one expression
+        combined = False
+
+    _pattern_cache.set(key, combined)
+    return combined or None
+
+class AttributeMatcher(FieldMatcher):
+    """
+    A matcher that matches fields by their widget class, form field class
+    or flags.
+
+    Supported kinds are:
+    widget - match fields whose widget class has the given name
+    type   - match fields whose form field class has the given name
+    is     - match fields with the given flag ("required" or "hidden-initial")
+
+    Attribute matchers have lower precedence than name matchers. Optional
+    attribute matchers have lower precedence than required ones.
+    """
+    __slots__ = ('kind', 'value', 'optional')
+
+    PRECEDENCE = {'widget': 20, 'type': 21, 'is': 30}
+
+    def __init__(self, kind, value, optional=False):
+        if kind == 'is' and value not in _FIELD_FLAGS:
+            raise FormTagError("Unknown field flag: {0}".format(value))
+        if not value:
+            raise FormTagError("Missing {0} matcher value".format(kind))
+
+        super(AttributeMatcher, self).__init__(
+            kind + ':' + value,
+            self.PRECEDENCE[kind] + (2 if optional else 0))
+        self.kind = kind
+        self.value = value
+        self.optional = optional
+
+    def match(self, field, field_order):
+        return self.value in _field_attributes(self.kind, field.field)
+
+    def select(self, index):
+        return index.attribute(self.kind, self.value)
+
+    def is_required(self):
+        return not self.optional
+
+_FIELD_FLAGS = {
+    'required': lambda f: f.required,
+    'hidden-initial': lambda f: f.show_hidden_initial,
+    }
+
+def _field_attributes(kind, field):
+    """
+    Return the values an attribute matcher of the given kind matches
+    for the form field.
+    """
+    if kind == 'widget':
+        return (type(field.widget).__name__,)
+    elif kind == 'type':
+        return (type(field).__name__,)
+    else:
+        return tuple(flag for (flag, test) in _FIELD_FLAGS.items() if test(field))
+
+def _attribute_signature(fields):
+    """
+    Return a hashable signature of the attributes of the fields that
+    attribute matchers depend on.
+    """
+    return tuple(
+        (type(f.field), type(f.field.widget), f.field.required, f.field.show_hidden_initial)
+        for f in fields)
+
+def _uses_attributes(tags):
+    """
+    Return true if any of the matchers of the tags is an attribute matcher.
+    """
+    return any(isinstance(m, AttributeMatcher) for matchers in tags for m in matchers)
+
+def parse_matcher(m):
+    """
+    Parse a matcher definition string into a matcher object.
+
+    Matcher objects are immutable and may be shared between renders.
+    """
+    if not m:
+        return AnyMatcher()
+
+    kind, sep, value = m.partition(':')
+    if sep and kind in AttributeMatcher.PRECEDENCE:
+        if value[-1:] == '?':
+            return AttributeMatcher(kind, value[:-1], True)
+        return AttributeMatcher(kind, value)
+
+    if kind == 're' and sep:
+        return PatternMatcher('re', value)
+    elif kind == 're?' and sep:
+        return PatternMatcher('re', value, True)
+
+    if m[0] == '>' or m[0] == '<':
+        if m[1:2] == '=':
+            return RelativeMatcher(m[0:2], m[2:])
+        else:
+            return RelativeMatcher(m[0], m[1:])
+
+    optional = m[-1] == '?'
+    name = m[0:-1] if optional else m
+    if '?' in name or name.count('*') > 1 or '*' in name[1:-1]:
+        return PatternMatcher('glob', name, optional)
+    elif optional:
+        return OptionalNameMatcher(name)
+    else:
+        return NameMatcher(name)
+
+_matcher_cache = _LRUCache(MATCHER_CACHE_SIZE)
+
+def _get_matcher(m):
+    """
+    Return a parsed matcher for a definition string resolved at render time.
+    """
+    matcher = _matcher_cache.get(m)
+    if matcher is None:
+        matcher = parse_matcher(m)
+        _matcher_cache.set(m, matcher)
+    return matcher
+
+class _FieldInfo(object):
+    """
+    Stands for a bound field when assigning the fields of a form class.
+    """
+    __slots__ = ('name', 'field')
+
+    def __init__(self, name, field):
+        self.name = name
+        self.field = field
+
+class FieldIndex(object):
+    """
+    Lookup structures for matching a list of form fields by name and
+    attributes.
+
+    The prefix, suffix and attribute lookup tables are built on first use.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.order = dict((f.name, idx) for (idx, f) in enumerate(fields))
+        self._names = None
+        self._reversed_names = None
+        self._attributes = {}
+        self._patterns = None
+
+    def exact(self, name):
+        """
+        Return the index of the named field as a list.
+        """
+        idx = self.order.get(name)
+        return [] if idx is None else [idx]
+
+    def prefixed(self, prefix):
+        """
+        Return the indices of fields whose names start with the prefix.
+        """
+        if self._names is None:
+            self._names = sorted(self.order)
+        return [self.order[n] for n in _scan_prefix(self._names, prefix)]
+
+    def suffixed(self, suffix):
+        """
+        Return the indices of fields whose names end with the suffix.
+        """
+        if self._reversed_names is None:
+            self._reversed_names = sorted(n[::-1] for n in self.order)
+        return [self.order[n[::-1]] for n in _scan_prefix(self._reversed_names, suffix[::-1])]
+
+    def classify(self, matchers):
+        """
+        Classify the field names against the pattern matchers in one scan.
+
+        Each field is assigned to the first matcher in the list it matches,
+        so the list must be in the order the matchers grab fields.
+        """
+        self._patterns = patterns = dict((m, []) for m in matchers)
+        combined = _combine_patterns(matchers)
+        if combined is None:
+            rest = matchers
+        else:
+            regex, groups = combined
+            for idx, f in enumerate(self.fields):
+                mo = regex.fullmatch(f.name)
+                if mo is not None:
+                    patterns[matchers[groups[mo.lastindex]]].append(idx)
+            rest = [m for (pos, m) in enumerate(matchers) if pos not in groups.values()]
+
+        for m in rest:
+            patterns[m] = [
+                idx for (idx, f) in enumerate(self.fields) if m.match(f, self.order)]
+
+    def pattern(self, matcher):
+        """
+        Return the indices of fields matched by a pattern matcher.
+
+        If the fields were classified, only the fields not claimed by
+        earlier matchers are returned.
+        """
+        if self._patterns is None or matcher not in self._patterns:
+            return [idx for (idx, f) in enumerate(self.fields) if matcher.match(f, self.order)]
+        return self._patterns[matcher]
+
+    def attribute(self, kind, value):
+        """
+        Return the indices of fields having the given attribute value.
+
+        Arguments:
+        kind  -- "widget", "type" or "is"
+        value -- widget class name, form field class name or flag name
+        """
+        table = self._attributes.get(kind)
+        if table is None:
+            table = self._attributes[kind] = {}
+            for idx, f in enumerate(self.fields):
+                for val in _field_attributes(kind, f.field):
+                    table.setdefault(val, []).append(idx)
+        return table.get(value, [])
+
+def _scan_prefix(names, prefix):
+    """
+    Yield the names starting with the given prefix from a sorted list.
+    """
+    for i in range(bisect_left(names, prefix), len(names)):
+        if not names[i].startswith(prefix):
+            break
+        yield names[i]
+
+class _RenderState(object):
+    """
+    Form rendering state.
+    """
+    __slots__ = (
+        'render',   # are we in render phase yet?
+        'tags',     # form field matcher tags
+        'nodes',    # field tag nodes, indexed by tag id
+        'fields',   # matched fields per tag, indexed by tag id
+        'matches',  # set of matcher names that matched fields
+        'dynamic',  # were any matchers resolved from variables?
+        'cursor',   # id of the next tag to render
+        'parents',  # ids of the enclosing field tags, indexed by tag id
+        'parent',   # id of the field tag being gathered, or -1
+        'markers',  # _SpanMarkers to emit around fields, or None
+        'choices',  # choice tables by field name
+        'stats',    # a RenderStats instance, if statistics are collected
+        )
+
+    def __init__(self):
+        self.render = False
+        self.tags = []
+        self.nodes = []
+        self.fields = []
+        self.matches = set()
+        self.dynamic = False
+        self.cursor = 0
+        self.parents = []
+        self.parent = -1
+        self.markers = None
+        self.choices = {}
+        self.stats = None
+
+class RenderStats(object):
+    """
+    Statistics of a form render, sent with the form_rendered signal.
+
+    gather_time         -- seconds spent in the gathering pass
+    assign_time         -- seconds spent assigning fields to tags, including
+                           prefetching lazy choices
+    render_time         -- seconds spent in the render pass. When streaming,
+                           this includes the time spent by the consumer.
+    fields              -- number of assigned fields
+    tags                -- number of field tags
+    matcher_evaluations -- number of candidate fields tested by matchers
+    choices             -- number of choices rendered by field_choices tags
+    """
+    __slots__ = (
+        'gather_time', 'assign_time', 'render_time',
+        'fields', 'tags', 'matcher_evaluations', 'choices',
+        )
+
+    def __init__(self):
+        self.gather_time = 0.0
+        self.assign_time = 0.0
+        self.render_time = 0.0
+        self.fields = 0
+        self.tags = 0
+        self.matcher_evaluations = 0
+        self.choices = 0
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+class _ChoiceTable(object):
+    """
+    A flattened, immutable representation of a field's choices.
+
+    values, labels -- the choices, with option groups flattened
+    suffixes       -- the choice ID suffixes ("_0", "_1", ...)
+    groups         -- tuple of (label, start, end, choices) tuples. Consecutive
+                      ungrouped choices form unnamed groups with an empty label.
+    """
+    __slots__ = ('values', 'labels', 'suffixes', 'groups')
+
+    def __init__(self, choices):
+        values = []
+        labels = []
+        groups = []
+        unnamed = None
+        for option in choices:
+            if isinstance(option[1], (tuple, list)):
+                start = len(values)
+                for val, lbl in option[1]:
+                    values.append(val)
+                    labels.append(lbl)
+                groups.append([option[0], start, len(values), option[1]])
+                unnamed = None
+
+            else:
+                if unnamed is None:
+                    unnamed = ['', len(values), len(values), []]
+                    groups.append(unnamed)
+                values.append(option[0])
+                labels.append(option[1])
+                unnamed[2] += 1
+                unnamed[3].append(option)
+
+        self.values = tuple(values)
+        self.labels = tuple(labels)
+        self.suffixes = tuple('_{0}'.format(i) for i in range(len(values)))
+        self.groups = tuple(
+            (label, start, end, tuple(group)) for (label, start, end, group) in groups)
+
+# Maximum number of choice tables shared between renders
+CHOICE_TABLE_CACHE_SIZE = 128
+
+_choice_table_cache = _LRUCache(CHOICE_TABLE_CACHE_SIZE)
+
+def _choices_key(choices):
+    """
+    Return a key identifying static choices by content. The key includes
+    the types of the values and labels, as equal values of different types
+    (such as 1 and True) render differently.
+    """
+    return tuple(
+        (type(value), value,
+            _choices_key(label) if isinstance(label, (list, tuple)) else (type(label), label))
+        for (value, label) in choices)
+
+def _choice_table(state, field):
+    """
+    Return the choice table of the field.
 
-def _assign_fields(form, state):
+    The table is built once per field per form render, so lazy choices
+    (such as the queryset of a ModelChoiceField) are evaluated only once
+    no matter how many tags iterate them. Tables for static choice lists
+    are also shared between renders.
+    """
+    tables = state.choices
+    try:
+        return tables[field.name]
+    except KeyError:
+        pass
+
+    choices = field.field.choices
+    if isinstance(choices, (list, tuple)):
+        # Form instances get deep copies of their fields' choices,
+        # so static choices are identified by content.
+        key = _choices_key(choices)
+        try:
+            table = _choice_table_cache.get(key)
+        except TypeError:
+            # Unhashable choice values
+            key = table = None
+
+        if table is None:
+            table = _ChoiceTable(choices)
+            if key is not None:
+                _choice_table_cache.set(key, table)
+
+    else:
+        table = _ChoiceTable(list(choices))
+
+    tables[field.name] = table
+    return table
+
+_prefetch_lock = threading.Lock()
+_prefetch_pool = (0, None)
+
+def _get_prefetch_pool(threads):
+    """
+    Return the shared thread pool for prefetching choices.
+    """
+    global _prefetch_pool
+    with _prefetch_lock:
+        size, executor = _prefetch_pool
+        if size != threads:
+            if executor is not None:
+                executor.shutdown(wait=False)
+            executor = ThreadPoolExecutor(
+                max_workers=threads, thread_name_prefix='formtags-prefetch')
+            _prefetch_pool = (threads, executor)
+        return executor
+
+def _load_choices(field, language, tz):
+    """
+    Evaluate the lazy choices of a field into a choice table.
+
+    Runs in a prefetch thread, which uses its own database connections,
+    with the language and time zone of the rendering thread activated.
+    """
+    try:
+        with translation.override(language), timezone.override(tz):
+            return _ChoiceTable(list(field.field.choices))
+    finally:
+        close_old_connections()
+
+def _prefetch_choices(state):
+    """
+    Evaluate the lazy choices (such as querysets) of the assigned fields
+    whose tags iterate choices, concurrently on the prefetch thread pool.
+
+    The choice tables are stored in state.choices, where the choice tags
+    find them. The number of threads is given by the
+    FORMTAGS_PREFETCH_THREADS setting; by default, nothing is prefetched.
+    Choices are not prefetched inside a transaction, as other threads'
+    connections would not see its changes.
+    """
+    threads = getattr(settings, 'FORMTAGS_PREFETCH_THREADS', 0)
+    if not threads:
+        return
+
+    fields = [
+        f for (node, tag_fields) in zip(state.nodes, state.fields)
+        if node.uses_choices
+        for f in tag_fields
+        if not isinstance(f.field.choices, (list, tuple)) and f.name not in state.choices
+        ]
+    if len(fields) < 2:
+        # Nothing to overlap
+        return
+
+    if any(conn.in_atomic_block for conn in connections.all()):
+        return
+
+    pool = _get_prefetch_pool(threads)
+    tables = pool.map(
+        _load_choices, fields,
+        repeat(get_language()), repeat(timezone.get_current_timezone()))
+    for f, table in zip(fields, tables):
+        state.choices[f.name] = table
+
+def _assign_fields(fields, state):
     """
     Order the matched form fields in the true order of the field tags.
-    The ordered field list will be set to state['fields'].
+    The ordered field list will be set to state.fields.
     The output is a a list of tuples corresponding to the list
     of matchers. The matchers will be applied in order of their precedence.
     For optional matchers, the corresponding tuples may be empty.
@@ -325,103 +1141,857 @@ def _assign_fields(form, state):
     which matched one or more field.
 
     Arguments:
-    form  -- the form whose fields to match
-    state -- form rendering state
+    fields -- the visible fields of the form
+    state  -- form rendering state
 
     """
 
     # Sort matcher list in order of precedence, but remember
     # the original order too
     matcher_list = []
-    for i, matchers in enumerate(state['tags']):
+    for i, matchers in enumerate(state.tags):
         for m in matchers:
-            matcher_list.append((i, m.precedence(), m))
+            matcher_list.append((i, m.precedence, m))
 
     matcher_list.sort(key=lambda m: m[1])
 
     # Let the sorted matchers greedily grab all the fields they can.
     # The results are stored in the original order.
-    fields = form.visible_fields()
-    field_order = dict((f.name, idx) for (idx, f) in enumerate(fields))
+    index = FieldIndex(fields)
+    patterns = [m for (tag, prec, m) in matcher_list if isinstance(m, PatternMatcher)]
+    if patterns:
+        index.classify(patterns)
+
+    remaining = bytearray(b'\x01') * len(fields)
+    left = len(fields)
 
-    assigned = deque([[] for x in range(len(state['tags']))])
-    for m in matcher_list:
-        taken = _take(fields, field_order, m[2])
+    assigned = [[] for x in range(len(state.tags))]
+    for tag, prec, matcher in matcher_list:
+        candidates = matcher.select(index)
+        if state.stats is not None:
+            state.stats.matcher_evaluations += len(candidates)
+
+        taken = sorted(i for i in candidates if remaining[i])
         if taken:
-            state['matches'].add(m[2].definition_string)
-            assigned[m[0]].extend(taken)
+            for i in taken:
+                remaining[i] = 0
+            left -= len(taken)
+            state.matches.add(matcher.definition_string)
+            assigned[tag].extend(fields[i] for i in taken)
+
+        elif matcher.is_required():
+            raise FormTagError("Matcher {0!r} did not match any field!".format(matcher))
 
     # Done. Left over fields indicate a bug in the template.
-    if len(fields) > 0:
-        raise FormTagError("{0} form field(s) left over!".format(len(fields)))
+    if left > 0:
+        raise FormTagError("{0} form field(s) left over!".format(left))
+
+    state.fields = assigned
+
+def _count_assigned(state):
+    """
+    Add the number of tags and assigned fields to the render statistics.
+    """
+    state.stats.tags += len(state.tags)
+    state.stats.fields += sum(len(f) for f in state.fields)
+
+def _subtree_end(parents, tag):
+    """
+    Return the id following the last field tag nested in the given tag.
+
+    Nested field tags are gathered right after their enclosing tag, so
+    the tags nested in a tag have consecutive ids.
+    """
+    end = tag + 1
+    while end < len(parents) and parents[end] >= tag:
+        end += 1
+    return end
+
+def _static_parents(nodes):
+    """
+    Return the ids of the enclosing field tags of statically known field
+    tags, indexed by tag id.
+    """
+    parents = []
+    for j, node in enumerate(nodes):
+        enclosing = [
+            i for i in range(j)
+            if any(n is node for n in nodes[i].nodelist.get_nodes_by_type(FieldNode))]
+        parents.append(enclosing[-1] if enclosing else -1)
+    return parents
+
+def _make_plan(names, state):
+    """
+    Record the field assignment of the state as a plan: a tuple of field
+    indices per tag and the set of matchers that matched.
+
+    Arguments:
+    names -- the names of the visible fields, in order
+    state -- a form rendering state after field assignment
+    """
+    field_order = dict((name, idx) for (idx, name) in enumerate(names))
+    return (
+        tuple(tuple(field_order[f.name] for f in tf) for tf in state.fields),
+        frozenset(state.matches),
+        )
+
+def _assign_planned(plans, form, state):
+    """
+    Assign the form's fields to the tags of the state, using a cached plan
+    if possible.
+
+    When all the matchers are literals, the assignment depends only on the
+    form's visible fields and the registered matchers, so it is recorded
+    as a plan and reused.
+
+    Arguments:
+    plans -- a cache of plans
+    form  -- the form whose fields to assign
+    state -- form rendering state
+    """
+    fields = form.visible_fields()
+    if state.dynamic:
+        _assign_fields(fields, state)
+        return
+
+    names = tuple(f.name for f in fields)
+    key = (type(form), names, _tag_signature(state))
+    if _uses_attributes(state.tags):
+        # The widgets and fields may be altered per form instance
+        key += (_attribute_signature(fields),)
+
+    plan = plans.get(key)
+    if plan is not None:
+        # Skip matching
+        state.fields = [[fields[i] for i in idx] for idx in plan[0]]
+        state.matches.update(plan[1])
+        return
+
+    _assign_fields(fields, state)
+    plans.set(key, _make_plan(names, state))
+
+def _tag_signature(state):
+    """
+    Return a hashable signature of the matchers registered during
+    the gathering pass.
+    """
+    return tuple(
+        tuple((type(m), m.definition_string) for m in matchers)
+        for matchers in state.tags)
+
+def _gather_nodes(nodelist):
+    """
+    Return the nodes of the list that take part in the gathering pass.
+
+    These are the field tags, the nodes enclosing them and the nodes that
+    may load templates containing field tags at render time. Nested forms
+    are skipped, as they gather their own fields, and so are nodes that
+    enclose field tags only inside nested forms.
+    """
+    return [
+        n for n in nodelist
+        if isinstance(n, FieldNode) or (
+            not isinstance(n, FormNode) and (_encloses_fields(n) or _loads_templates(n)))
+        ]
+
+def _encloses_fields(node):
+    """
+    Return true if the node encloses field tags outside nested forms.
+    """
+    fields = node.get_nodes_by_type(FieldNode)
+    if not fields:
+        return False
+
+    nested = set(
+        id(f) for form in node.get_nodes_by_type(FormNode)
+        for f in form.nodelist.get_nodes_by_type(FieldNode))
+    return any(id(f) not in nested for f in fields)
+
+def _loads_templates(node):
+    """
+    Return true if the node (or a node enclosed by it) may render other
+    templates or block overrides, whose field tags can't be seen at compile
+    time. Tags from other libraries that have content are assumed to do so.
+    """
+    for n in node.get_nodes_by_type(template.Node):
+        if isinstance(n, (IncludeNode, BlockNode, ExtendsNode)):
+            return True
+        if not type(n).__module__.startswith(('django.template.', __name__)) and any(
+                getattr(n, attr, None) for attr in n.child_nodelists):
+            return True
+    return False
+
+def _in_gathering_pass(context):
+    """
+    Return true if the context is being rendered in the gathering pass of
+    an enclosing form.
+    """
+    return STATEVAR in context and not context[STATEVAR].render
+
+def _static_tags(nodes):
+    """
+    Return the (field tag node, matchers) pairs the gathering pass would
+    register for the nodes, or None if they depend on the context.
+    """
+    tags = []
+    for node in nodes:
+        if not isinstance(node, FieldNode):
+            return None
+        node_tags = node.static_tags()
+        if node_tags is None:
+            return None
+        tags.extend(node_tags)
+    return tags
+
+def _gather(nodes, context):
+    """
+    Run the gathering pass over the given nodes.
+
+    Field tags register their matchers. Conditional and scoping tags
+    are evaluated structurally so that only the field tags that would
+    actually run are visited. Any other node enclosing field tags is
+    rendered normally and its output discarded.
+    """
+    for node in nodes:
+        if isinstance(node, FieldNode):
+            node.gather(context)
+
+        elif isinstance(node, IfNode):
+            for condition, nodelist in node.conditions_nodelists:
+                if condition is not None:
+                    try:
+                        match = condition.eval(context)
+                    except template.VariableDoesNotExist:
+                        match = None
+                else:
+                    match = True
+
+                if match:
+                    _gather(_gather_nodes(nodelist), context)
+                    break
+
+        elif isinstance(node, FieldSwitchNode):
+            # The current field is not assigned yet in the gathering pass,
+            # so an implicit field switch (which may not contain field
+            # tags) is not visited.
+            if node.field is not None:
+                nodelist = node.branch(context)
+                if nodelist is not None:
+                    _gather(_gather_nodes(nodelist), context)
+
+        elif isinstance(node, WithNode):
+            values = dict((key, val.resolve(context)) for key, val in node.extra_context.items())
+            context.update(values)
+            _gather(_gather_nodes(node.nodelist), context)
+            context.pop()
+
+        else:
+            node.render(context)
+
+def _stream_nodelist(nodelist, context):
+    """
+    Render the nodes, yielding the output in chunks.
+
+    The tags of this library stream their content. Other nodes
+    are rendered whole.
+    """
+    for node in nodelist:
+        if isinstance(node, _STREAMING_NODES):
+            try:
+                for chunk in node.stream(context):
+                    yield chunk
+            except Exception as e:
+                _annotate_exception(e, node, context)
+                raise
+        else:
+            yield node.render_annotated(context)
+
+def _annotate_exception(e, node, context):
+    """
+    Add template debug information to an exception raised by a streamed
+    node, as Node.render_annotated does for rendered nodes.
+    """
+    if not context.template.engine.debug:
+        return
+
+    # Store the actual node that caused the exception.
+    if not hasattr(e, '_culprit_node'):
+        e._culprit_node = node
+    if (not hasattr(e, 'template_debug')
+            and context.render_context.template.origin == e._culprit_node.origin):
+        e.template_debug = context.render_context.template.get_exception_info(
+            e, e._culprit_node.token)
+
+def stream_template(tpl, context=None, request=None):
+    """
+    Render a template, yielding the output in chunks.
 
-    state['fields'] = assigned
+    The output of form tags is streamed during their render pass, so
+    the result can be fed to a StreamingHttpResponse without building
+    the whole page in memory first. Only form tags in the template's own
+    node list (not inside {% block %} overrides or other tags) are streamed.
 
-def _take(fields, field_order, matcher):
+    Arguments:
+    tpl     -- a template (either a django.template.Template or a
+               template returned by a template backend)
+    context -- a Context instance or a dictionary
+    request -- the request to use when making a context from a dictionary
+    """
+    tpl = getattr(tpl, 'template', tpl)
+    if not isinstance(context, template.Context):
+        context = make_context(context, request, autoescape=tpl.engine.autoescape)
+
+    with context.render_context.push_state(tpl):
+        if context.template is None:
+            with context.bind_template(tpl):
+                context.template_name = tpl.name
+                for chunk in _stream_nodelist(tpl.nodelist, context):
+                    yield chunk
+        else:
+            for chunk in _stream_nodelist(tpl.nodelist, context):
+                yield chunk
+
+def render_form_fragment(tpl, form, field_name, context=None, request=None, form_name=None):
+    """
+    Render only the field tag of a template that renders the named field.
+
+    Arguments:
+    tpl        -- a template (either a django.template.Template or a
+                  template returned by a template backend)
+    form       -- the form instance
+    field_name -- the name of the field to render
+    context    -- a Context instance or a dictionary
+    request    -- the request to use when making a context from a dictionary
+    form_name  -- the context variable of the form tag to use. By default,
+                  the first form tag of the template is used.
+    """
+    tpl = getattr(tpl, 'template', tpl)
+    if not isinstance(context, template.Context):
+        context = make_context(context, request, autoescape=tpl.engine.autoescape)
+
+    node = _find_form_node(tpl, form_name)
+
+    with context.render_context.push_state(tpl):
+        if context.template is None:
+            with context.bind_template(tpl):
+                context.template_name = tpl.name
+                return node.render_fragment(form, field_name, context)
+        else:
+            return node.render_fragment(form, field_name, context)
+
+class _SpanMarkers(object):
+    """
+    Markers around the output of each field while rendering a RenderMap.
+
+    The markers contain a random token generated for each render, so
+    rendered data can neither contain nor break them.
+    """
+    __slots__ = ('node', 'token', 'end', 'regex')
+
+    def __init__(self, node):
+        self.node = node
+        self.token = u'\x00' + uuid.uuid4().hex
+        self.end = self.token + u'/'
+        self.regex = re.compile(re.escape(self.token) + u'(?:<([^\x00]*)\x00|/)')
+
+    def start(self, names):
+        return self.token + u'<' + u' '.join(names) + u'\x00'
+
+    def strip(self, marked):
+        """
+        Remove the markers from the output, returning the output and the
+        map of field names to spans.
+        """
+        out = []
+        spans = {}
+        pos = 0
+        length = 0
+        open_names = None
+        for m in self.regex.finditer(marked):
+            out.append(marked[pos:m.start()])
+            length += m.start() - pos
+            pos = m.end()
+            if m.group(1) is not None:
+                open_names = (m.group(1).split(' '), length)
+            elif open_names is not None:
+                names, start = open_names
+                for name in names:
+                    spans[name] = (start, length)
+                open_names = None
+        out.append(marked[pos:])
+        return u''.join(out), spans
+
+def _span_markers(context, node):
+    """
+    Return the span markers if the form node is rendered for a RenderMap.
+    """
+    markers = context.get(MAPVAR)
+    if markers is not None and markers.node is node:
+        return markers
+    return None
+
+class RenderMap(object):
+    """
+    The output of a form render, with the span of the output of each field.
+
+    html   -- the rendered output
+    spans  -- map of field names to (start, end) offsets in the output.
+              Fields nested in the same outermost field tag share a span.
+    errors -- map of field names to the field's error messages at the time
+              of rendering
+    """
+    __slots__ = ('html', 'spans', 'errors')
+
+    def __init__(self, html, spans, errors):
+        self.html = html
+        self.spans = spans
+        self.errors = errors
+
+def _find_form_node(tpl, form_name):
+    """
+    Return the form tag of the template with the given context variable,
+    or the first form tag if form_name is None.
+    """
+    for node in tpl.nodelist.get_nodes_by_type(FormNode):
+        if not isinstance(node, FormsetNode) and form_name in (None, node.form):
+            return node
+    raise FormTagError("No form tag found in template {0!r}".format(tpl.name))
+
+def _field_errors(form):
+    return dict((f.name, [str(e) for e in f.errors]) for f in form.visible_fields())
+
+def render_form_map(tpl, form, context=None, request=None, form_name=None):
+    """
+    Render a template and return a RenderMap of the output of a form tag.
+
+    Arguments:
+    tpl        -- a template (either a django.template.Template or a
+                  template returned by a template backend)
+    form       -- the form instance
+    context    -- a Context instance or a dictionary
+    request    -- the request to use when making a context from a dictionary
+    form_name  -- the context variable of the form tag to map. By default,
+                  the first form tag of the template is used.
+    """
+    tpl = getattr(tpl, 'template', tpl)
+    if not isinstance(context, template.Context):
+        context = make_context(context, request, autoescape=tpl.engine.autoescape)
+    node = _find_form_node(tpl, form_name)
+
+    context.push()
+    try:
+        context[node.form] = form
+        markers = context[MAPVAR] = _SpanMarkers(node)
+        marked = tpl.render(context)
+    finally:
+        context.pop()
+
+    html, spans = markers.strip(marked)
+    return RenderMap(html, spans, _field_errors(form))
+
+def render_form_patches(tpl, form, previous, context=None, request=None, form_name=None,
+        fields=None):
     """
-    Take matching fields from the list.
+    Re-render the changed fields of a form rendered with render_form_map.
 
-    The elements are removed from the list and returned
-    as a new list.
+    Returns a tuple of the patches, a list of (start, end, html) tuples
+    replacing spans of the previous output (in order), and the RenderMap
+    of the patched output.
 
     Arguments:
-    fields      -- the list of fields to process
-    field_order -- map of field name to original index number
-    matcher     -- the matcher to apply to each list element.
+    tpl        -- the template of the previous render
+    form       -- the form instance
+    previous   -- the RenderMap of the previous render
+    context    -- a Context instance or a dictionary
+    request    -- the request to use when making a context from a dictionary
+    form_name  -- the context variable of the form tag
+    fields     -- names of the fields to re-render. By default, the fields
+                  in form.changed_data and the fields whose errors changed
+                  are re-rendered.
+    """
+    tpl = getattr(tpl, 'template', tpl)
+    if not isinstance(context, template.Context):
+        context = make_context(context, request, autoescape=tpl.engine.autoescape)
+    node = _find_form_node(tpl, form_name)
+
+    errors = _field_errors(form)
+    if fields is None:
+        fields = set(form.changed_data)
+        fields.update(
+            name for (name, messages) in errors.items()
+            if messages != previous.errors.get(name, []))
+
+    # One patch per span
+    targets = {}
+    for name in fields:
+        span = previous.spans.get(name)
+        if span is not None:
+            targets.setdefault(span, name)
+
+    patches = []
+    with context.render_context.push_state(tpl):
+        if context.template is None:
+            with context.bind_template(tpl):
+                context.template_name = tpl.name
+                for span, name in sorted(targets.items()):
+                    patches.append(span + (node.render_fragment(form, name, context, True),))
+        else:
+            for span, name in sorted(targets.items()):
+                patches.append(span + (node.render_fragment(form, name, context, True),))
+
+    # Apply the patches and move the spans
+    out = []
+    pos = 0
+    shifts = []
+    for start, end, html in patches:
+        out.append(previous.html[pos:start])
+        out.append(html)
+        pos = end
+        shifts.append((start, end, len(html) - (end - start)))
+    out.append(previous.html[pos:])
+
+    spans = {}
+    for name, span in previous.spans.items():
+        start, end = span
+        for (pstart, pend, delta) in shifts:
+            if (pstart, pend) == span:
+                end += delta
+            elif pend <= span[0]:
+                start += delta
+                end += delta
+        spans[name] = (start, end)
+
+    return patches, RenderMap(u''.join(out), spans, errors)
+
+_local_fragment_cache = _LRUCache(FRAGMENT_CACHE_SIZE)
+
+def _fragment_cache():
+    """
+    Return the cache for rendered output.
+
+    If the FORMTAGS_CACHE setting names a configured Django cache, that
+    cache is used. Otherwise, output is kept in a bounded in-process cache.
+    """
+    alias = getattr(settings, 'FORMTAGS_CACHE', None)
+    if alias:
+        return caches[alias]
+    return _local_fragment_cache
+
+def _block_identity(node):
+    """
+    Return a string identifying the template block of the node.
 
+    Blocks of templates loaded from files are identified by their location,
+    which is the same in every process. Blocks of templates compiled from
+    strings get an identity unique to the node.
     """
-    matched = []
-    for f in fields:
-        if matcher.match(f, field_order):
-            matched.append(f)
+    if node._block_id is None:
+        origin = getattr(node, 'origin', None)
+        token = getattr(node, 'token', None)
+        if origin is not None and origin.loader is not None and token is not None:
+            node._block_id = u'{0}:{1}:{2}'.format(origin.name, token.position, token.contents)
+        else:
+            node._block_id = uuid.uuid4().hex
+    return node._block_id
 
-    if len(matched) > 0:
-        fields[:] = filter(lambda f: f not in matched, fields)
+def _cache_key(prefix, *parts):
+    """
+    Make a cache key from the repr of the given parts.
+    """
+    return prefix + hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
 
-    elif matcher.is_required():
-        raise FormTagError("Matcher {0!r} did not match any field!".format(matcher))
+def _class_path(cls):
+    return cls.__module__ + '.' + cls.__qualname__
 
-    return matched
+def _field_identity(field):
+    """
+    Return the parts of a cache key identifying the output of a bound
+    field, or None if the field has lazy choices (such as a queryset),
+    which can't be identified without evaluating them.
+    """
+    f = field.field
+    choices = getattr(f, 'choices', None)
+    if choices is not None and not isinstance(choices, (list, tuple)):
+        return None
+
+    widget = f.widget
+    return (
+        _class_path(type(field.form)),
+        _class_path(type(f)),
+        field.html_name,
+        field.auto_id,
+        str(field.label),
+        str(field.help_text),
+        f.label_suffix,
+        field.form.label_suffix,
+        f.required,
+        f.disabled,
+        f.show_hidden_initial,
+        f.localize,
+        _class_path(type(widget)),
+        sorted(field.build_widget_attrs(widget.attrs).items()),
+        choices,
+        field.value(),
+        [str(e) for e in field.errors],
+        )
+
+# Maximum number of cached assignment plans per form node
+PLAN_CACHE_SIZE = 64
+
+# Stands for the CSRF token in cached form output
+CSRF_PLACEHOLDER = 'formtagsCSRFTOKENPLACEHOLDER'
 
 class FormNode(template.Node):
     """
     Container node for fields.
 
     Form nodes can be nested.
+
+    If caching is enabled, the output of unbound forms without errors is
+    cached, keyed by the form class, prefix, auto_id and resolved initial
+    values, the active language and the identity of the block.
+
+    When all the field tags use literal matchers, the result of field
+    assignment depends only on the form's visible fields and the
+    registered matchers. The assignment is then recorded as a plan
+    (field indices per tag) and reused on subsequent renders.
     """
-    def __init__(self, nodelist, form):
+    def __init__(self, nodelist, form, cache=False, form_class=None):
         self.nodelist = nodelist
         self.form = form
+        self.cache = cache
+        self._plans = _LRUCache(PLAN_CACHE_SIZE)
+        self._gather_nodes = _gather_nodes(nodelist)
+        self._block_id = None
+        self._bound = None
+        if form_class is not None:
+            self._bind(form_class)
+
+    def _assign(self, form, state):
+        """
+        Assign fields to tags, using a cached plan if possible.
+        """
+        _assign_planned(self._plans, form, state)
+
+    def _bind(self, form_class):
+        """
+        Compute the field assignment for the given form class at compile time.
+
+        The field tags must be statically known: they must use literal
+        matchers and may not be enclosed in other tags (apart from field
+        tags). Matching errors are raised immediately.
+        """
+        static = _static_tags(self._gather_nodes)
+        if static is None:
+            raise FormTagError(
+                "{0!r}: a form bound to a class may only contain field tags "
+                "with literal matchers outside other tags".format(self))
+        nodes = [node for (node, matchers) in static]
+        tags = [matchers for (node, matchers) in static]
+
+        fields = [
+            _FieldInfo(name, f) for (name, f) in form_class.base_fields.items()
+            if not f.widget.is_hidden
+            ]
+
+        state = _RenderState()
+        state.tags = tags
+        _assign_fields(fields, state)
+
+        names = tuple(f.name for f in fields)
+        if _uses_attributes(tags):
+            attributes = _attribute_signature(fields)
+        else:
+            attributes = None
+        self._bound = (
+            form_class, names, attributes, tags, nodes, _static_parents(nodes),
+            _make_plan(names, state))
+
+    def _assign_bound(self, form, state):
+        """
+        Use the assignment computed at compile time, if it applies to the form.
+
+        Returns False if the form's class or visible fields differ from the
+        ones the template was bound to.
+        """
+        form_class, names, attributes, tags, nodes, parents, plan = self._bound
+        if type(form) is not form_class:
+            return False
+
+        fields = form.visible_fields()
+        if tuple(f.name for f in fields) != names:
+            return False
+        if attributes is not None and _attribute_signature(fields) != attributes:
+            return False
+
+        state.tags = tags
+        state.nodes = nodes
+        state.parents = parents
+        state.fields = [[fields[i] for i in idx] for idx in plan[0]]
+        state.matches.update(plan[1])
+        return True
 
     def render(self, context):
+        return u''.join(self.stream(context))
+
+    def stream(self, context):
+        """
+        Render the form, yielding the output in chunks.
+        """
         form = context.get(self.form, None)
-        if form is None:
-            return u''
+        if form is None or _in_gathering_pass(context):
+            # A nested form produces no output in the gathering pass
+            # of the enclosing form, so it is not rendered at all.
+            return
+
+        if (self.cache and not form.is_bound and not getattr(form, '_errors', None)
+                and _span_markers(context, self) is None):
+            yield self._render_cached(form, context)
+            return
+
+        for chunk in self._stream_form(form, context):
+            yield chunk
+
+    def _render_cached(self, form, context):
+        """
+        Render an unbound form, using the fragment cache.
+
+        A CSRF token in the output is replaced with a placeholder in the
+        cache and substituted with the current token when served. Forms
+        with fields with lazy choices are not cached.
+        """
+        fields = []
+        for name in form.fields:
+            identity = _field_identity(form[name])
+            if identity is None:
+                return u''.join(self._stream_form(form, context))
+            fields.append(identity)
+
+        has_csrf = 'csrf_token' in context
+        key = _cache_key(
+            'formtags.form.',
+            _block_identity(self),
+            _class_path(type(form)),
+            form.prefix,
+            form.auto_id,
+            fields,
+            get_language(),
+            has_csrf,
+            )
+
+        cache = _fragment_cache()
+        out = cache.get(key)
+        if out is None:
+            if has_csrf:
+                context.update({'csrf_token': CSRF_PLACEHOLDER})
+            try:
+                out = u''.join(self._stream_form(form, context))
+            finally:
+                if has_csrf:
+                    context.pop()
+            cache.set(key, out)
+
+        if has_csrf and CSRF_PLACEHOLDER in out:
+            out = out.replace(CSRF_PLACEHOLDER, str(context['csrf_token']))
+
+        return out
+
+    def _stream_form(self, form, context):
+        """
+        Run both passes over the form, yielding the rendered output in chunks.
+        """
+        stats = RenderStats() if form_rendered.receivers else None
 
         context.push()
+        try:
+            context[FORMVAR] = form
+            state = context[STATEVAR] = _RenderState()
+            state.stats = stats
+            state.markers = _span_markers(context, self)
+
+            start = time.perf_counter()
+            if self._bound is None or not self._assign_bound(form, state):
+                # Gather fields
+                _gather(self._gather_nodes, context)
+                if stats is not None:
+                    stats.gather_time = time.perf_counter() - start
+                    start = time.perf_counter()
+
+                # Assign fields to tags, taking matcher precedence in account
+                # This populates 'fields' and 'matches'.
+                self._assign(form, state)
+
+            _prefetch_choices(state)
+            if stats is not None:
+                stats.assign_time = time.perf_counter() - start
+                _count_assigned(state)
+
+            # Render
+            state.render = True
+            start = time.perf_counter()
+            for chunk in _stream_nodelist(self.nodelist, context):
+                yield chunk
+            if stats is not None:
+                stats.render_time = time.perf_counter() - start
+
+        finally:
+            context.pop()
+
+        if stats is not None:
+            form_rendered.send(sender=type(self), node=self, form=form, stats=stats)
+
+    def render_fragment(self, form, field_name, context, whole=False):
+        """
+        Assign the form's fields and render only the field tag rendering
+        the named field. See render_form_fragment.
 
-        # Gather fields
-        context[FORMVAR] = form
-        context[STATEVAR] = {
-            'render': False,  # are we in render phase yet?
-            'tags': [],       # form field matcher tags
-            'fields': [],     # matched fields are collected here
-            'matches': set(), # set of matcher names that matched fields
-        }
+        If whole is true, the field tags nested in the outermost enclosing
+        field tag are rendered in full, so the output is the same as that
+        of the field in a full render.
+        """
+        context.push()
+        try:
+            context[self.form] = form
+            context[FORMVAR] = form
+            state = context[STATEVAR] = _RenderState()
 
-        self.nodelist.render(context)
+            _gather(self._gather_nodes, context)
+            self._assign(form, state)
 
-        # Assign fields to tags, taking matcher precedence in account
-        # This populates 'fields' and 'matches'.
-        _assign_fields(form, context[STATEVAR])
+            for tag, fields in enumerate(state.fields):
+                match = [f for f in fields if f.name == field_name]
+                if match:
+                    break
+            else:
+                raise FormTagError("Field {0!r} is not rendered by a field tag".format(field_name))
+
+            # Render the outermost enclosing field tag. Of the field tags
+            # nested in it, only the ones enclosing the field are rendered.
+            path = set()
+            top = tag
+            while top != -1:
+                path.add(top)
+                top, outer = state.parents[top], top
+            top = outer
+
+            if whole:
+                state.fields[top] = [f for f in state.fields[top] if f.name == field_name] \
+                        or state.fields[top]
+            else:
+                for i in range(top, _subtree_end(state.parents, top)):
+                    if i == tag:
+                        state.fields[i] = match
+                    elif i not in path:
+                        state.fields[i] = []
 
-        # Render
-        context[STATEVAR]['render'] = True
-        out = self.nodelist.render(context)
-        
-        context.pop()
+            _prefetch_choices(state)
 
-        return out
+            state.render = True
+            state.cursor = top
+            return state.nodes[top].render(context)
+
+        finally:
+            context.pop()
 
     def __repr__(self):
         return '<Form node: {0}>'.format(self.form)
@@ -432,59 +2002,165 @@ class FieldNode(template.Node):
 
     Field tags can be nested, but the parent field may match only
     one field!
+
+    If caching is enabled, the output rendered for each field is cached.
+    The cache key consists of the form and field classes, the field's name,
+    ID, label, help text and label suffix, its required, disabled,
+    show_hidden_initial and localize flags, widget, widget attributes,
+    choices, value and errors, the active language and the identity of the
+    block. The content must not
+    depend on anything else. Fields with lazy choices are not cached.
     """
-    def __init__(self, nodelist, fieldvar, matchers):
+    def __init__(self, nodelist, fieldvar, matchers, cache=False):
+        """
+        Arguments:
+        nodelist -- the content of the tag
+        fieldvar -- name of the context variable for the current field
+        matchers -- list of matchers. Matchers given as string literals
+                    have already been parsed at compile time, the rest are
+                    filter expressions to resolve at render time.
+        cache    -- cache the output rendered for each field
+        """
         self.nodelist = nodelist
         self.__matchers = matchers
         self.__fieldvar = fieldvar
         self.__has_nested = len(self.get_nodes_by_type(FieldNode)) > 1
-
-    def render(self, context):
+        self.__cache = cache
+        self._block_id = None
+
+        if cache and self.__has_nested:
+            raise FormTagError("A cached field tag may not contain nested field tags")
+        self.__dynamic = not all(isinstance(m, FieldMatcher) for m in matchers)
+        self.__gather_nodes = _gather_nodes(nodelist)
+
+        # Do the choice tags of this tag (not of nested field tags) iterate
+        # the field's choices?
+        choice_nodes = (FieldChoicesNode, FieldChoiceGroupsNode)
+        nested = set(
+            id(n) for f in nodelist.get_nodes_by_type(FieldNode)
+            for n in f.nodelist.get_nodes_by_type(choice_nodes))
+        self.uses_choices = any(
+            id(n) not in nested for n in nodelist.get_nodes_by_type(choice_nodes))
+
+    def static_tags(self):
+        """
+        Return the (node, matchers) pairs of this tag and its nested field
+        tags, in gathering order, or None if they depend on the context.
+        """
+        if self.__dynamic:
+            return None
+
+        tags = [(self, self.__matchers)]
+        if self.__gather_nodes:
+            nested = _static_tags(self.__gather_nodes)
+            if nested is None:
+                return None
+            tags.extend(nested)
+        return tags
+
+    def gather(self, context):
+        """
+        Register this tag's matchers (and those of any nested field tags)
+        in the form rendering state.
+        """
         if STATEVAR not in context:
             raise FormTagError("Field tag must be nested in a form tag!")
 
-        if not context[STATEVAR]['render']:
-            # State 0: Field gathering.
-
-            matchers = []
-            if not self.__matchers:
-                matchers.append(AnyMatcher())
+        if self.__dynamic:
+            matchers = [
+                m if isinstance(m, FieldMatcher) else _get_matcher(m.resolve(context))
+                for m in self.__matchers
+                ]
+            context[STATEVAR].dynamic = True
+        else:
+            matchers = self.__matchers
+
+        state = context[STATEVAR]
+        state.tags.append(matchers)
+        state.nodes.append(self)
+        state.parents.append(state.parent)
+
+        # If nested fields are present (or may be loaded from other templates),
+        # they must register themselves as well
+        if self.__gather_nodes:
+            parent = state.parent
+            state.parent = len(state.tags) - 1
+            try:
+                _gather(self.__gather_nodes, context)
+            finally:
+                state.parent = parent
 
-            for mvar in self.__matchers:
-                m = mvar.resolve(context)
+    def render(self, context):
+        return u''.join(self.stream(context))
 
-                if m[0] == '>' or m[0] == '<':
-                    if m[1]=='=':
-                        matchers.append(RelativeMatcher(m[0:2], m[2:]))
-                    else:
-                        matchers.append(RelativeMatcher(m[0], m[1:]))
-                elif m[-1] == '?':
-                    matchers.append(OptionalNameMatcher(m[0:-1]))
-                else:
-                    matchers.append(NameMatcher(m))
+    def stream(self, context):
+        """
+        Render the assigned fields, yielding the output in chunks.
+        """
+        if STATEVAR not in context:
+            raise FormTagError("Field tag must be nested in a form tag!")
 
-            context[STATEVAR]['tags'].append(matchers)
+        if not context[STATEVAR].render:
+            # State 0: Field gathering. This is reached only when
+            # an enclosing tag was rendered during the gathering pass.
+            self.gather(context)
+            return
 
-            # If nested fields are present, we must render the content
-            # so they can register themselves as well
-            if self.__has_nested:
-                return self.nodelist.render(context)
-            else:
-                return u''
+        # State 1: Render assigned fields.
+        state = context[STATEVAR]
+        tag = state.cursor
+        fields = state.fields[tag]
+        state.cursor += 1
 
-        else:
-            # State 1: Render assigned fields.
-            fields = context[STATEVAR]['fields'].popleft()
+        nested = None
+        if state.markers is not None and state.parents[tag] == -1:
+            nested = [
+                f.name for i in range(tag + 1, _subtree_end(state.parents, tag))
+                for f in state.fields[i]]
 
-            context.push()
-            out = []
-            for f in fields:
+        context.push()
+        try:
+            for i, f in enumerate(fields):
+                if i:
+                    yield u'\n'
+                if nested is not None:
+                    yield state.markers.start([f.name] + nested)
                 context[self.__fieldvar] = f
                 context[CURFIELDVAR] = f
-                out.append(self.nodelist.render(context))
+                if self.__cache:
+                    yield self._render_cached(f, context)
+                else:
+                    for chunk in _stream_nodelist(self.nodelist, context):
+                        yield chunk
+                if nested is not None:
+                    yield state.markers.end
+        finally:
             context.pop()
 
-            return u'\n'.join(out)
+    def _render_cached(self, field, context):
+        """
+        Render the content for the field, using the fragment cache.
+
+        Fields with lazy choices (such as a queryset) are not cached, as
+        their choices can't be identified without evaluating them.
+        """
+        identity = _field_identity(field)
+        if identity is None:
+            return self.nodelist.render(context)
+
+        key = _cache_key(
+            'formtags.field.',
+            _block_identity(self),
+            identity,
+            get_language(),
+            )
+
+        cache = _fragment_cache()
+        out = cache.get(key)
+        if out is None:
+            out = self.nodelist.render(context)
+            cache.set(key, out)
+        return out
 
     def __repr__(self):
         return '<Field node: {0}>'.format(', '.join(repr(m) for m in self.__matchers))
@@ -505,10 +2181,10 @@ class IfFieldNode(template.Node):
         if STATEVAR not in context:
             raise FormTagError("If_field tag must be nested in a form tag!")
 
-        if not context[STATEVAR]['render']:
+        if not context[STATEVAR].render:
             return u''
 
-        if any(m.resolve(context) in context[STATEVAR]['matches'] for m in self.__matchers):
+        if any(m.resolve(context) in context[STATEVAR].matches for m in self.__matchers):
             return self.nodelists[0].render(context)
 
         else:
@@ -520,6 +2196,35 @@ class IfFieldNode(template.Node):
     def __repr__(self):
         return 'IfFieldNode node: ' + ' '.join(self.__matchers)
 
+def _value_key(value):
+    """
+    Coerce a choice value to the string form Django's widgets compare.
+    """
+    return '' if value is None else str(value)
+
+def _selected_values(field, data):
+    """
+    Return the set of selected choice values for the field.
+
+    The data is coerced like Django's choice widgets do: model instances
+    are converted to primary keys and all values to strings.
+    """
+    if data is None or data == '':
+        return frozenset()
+
+    data = field.field.prepare_value(data)
+    if not isinstance(data, (list, tuple, set, frozenset)):
+        data = (data,)
+
+    return frozenset(_value_key(v) for v in data)
+
+def _field_selection(field):
+    """
+    Return the set of selected choice values of the bound field, from its
+    submitted data or initial value like Django's widgets.
+    """
+    return _selected_values(field, field.value())
+
 class FieldChoicesNode(template.Node):
     """
     A convenience tag for looping through all the choices of a field.
@@ -545,55 +2250,54 @@ class FieldChoicesNode(template.Node):
         self.choice_var = choice_var
         
     def render(self, context):
-        if not context[STATEVAR]['render']:
-            return u''
-
-        field = context[CURFIELDVAR]
-        form = context[FORMVAR]
-
-        out = []
-        context.push()
+        return u''.join(self.stream(context))
 
-        d = getattr(field.field, 'data', form.initial.get(field.name, None))
+    def stream(self, context):
+        """
+        Render the choices, yielding the output in chunks.
+        """
+        if not context[STATEVAR].render:
+            return
 
-        def _render_choice(value, label, idx):
-            selected = d and value in d
-            context[self.choice_var] = {
-                'value': value,
-                'label': label,
-                'selected': selected,
-                'checked': 'checked=checked' if selected else '',
-                'index': idx,
-                'id': '{0}_{1}'.format(field.auto_id, idx),
-            }
-            out.append(self.nodelists[0].render(context))
+        field = context[CURFIELDVAR]
+        selected_values = _field_selection(field)
 
+        table = _choice_table(context[STATEVAR], field)
         if OPTGROUPVAR in context:
-            g = context[OPTGROUPVAR]
-            choices = g['choices']
-            choice_index = g['_next_idx']
-
+            start, end = context[OPTGROUPVAR]['_range']
         else:
-            choices = field.field.choices
-            choice_index = 0
-
-        if choices:
-            for cval, clbl in choices:
-                if isinstance(clbl, (tuple, list)):
-                    for val, lbl in clbl:
-                        _render_choice(val, lbl, choice_index)
-                        choice_index += 1
-
-                else:
-                    _render_choice(cval, clbl, choice_index)
-                    choice_index += 1
+            start, end = 0, len(table.values)
 
-        elif len(self.nodelists) > 1:
-            out.append(self.nodelists[1].render(context))
-            
-        context.pop()
-
-        return u''.join(out)
+        context.push()
+        try:
+            if context[STATEVAR].stats is not None:
+                context[STATEVAR].stats.choices += end - start
+
+            if start < end:
+                auto_id = field.auto_id
+                values = table.values
+                labels = table.labels
+                suffixes = table.suffixes
+                for idx in range(start, end):
+                    value = values[idx]
+                    selected = _value_key(value) in selected_values
+                    context[self.choice_var] = {
+                        'value': value,
+                        'label': labels[idx],
+                        'selected': selected,
+                        'checked': 'checked=checked' if selected else '',
+                        'index': idx,
+                        'id': auto_id + suffixes[idx],
+                    }
+                    for chunk in _stream_nodelist(self.nodelists[0], context):
+                        yield chunk
+
+            elif len(self.nodelists) > 1:
+                for chunk in _stream_nodelist(self.nodelists[1], context):
+                    yield chunk
+
+        finally:
+            context.pop()
 
     def __repr__(self):
         return '<FieldChoicesNode node: {0}>'.format(self.choice_var)
@@ -623,51 +2327,46 @@ class FieldChoiceGroupsNode(template.Node):
         self.group_var = group_var
 
     def render(self, context):
-        if not context[STATEVAR]['render']:
-            return u''
+        return u''.join(self.stream(context))
 
-        field = context[CURFIELDVAR]
+    def stream(self, context):
+        """
+        Render the choice groups, yielding the output in chunks.
+        """
+        if not context[STATEVAR].render:
+            return
 
-        groups = []
-        next_idx = 0
-        for option in field.field.choices:
-            if isinstance(option[1], (tuple, list)):
-                groups.append({
-                    'label': option[0],
-                    'index': len(groups),
-                    'choices': option[1],
-                    '_next_idx': next_idx,
-                    })
-                next_idx += len(option[1])
+        field = context[CURFIELDVAR]
 
-            else:
-                if not groups or groups[-1].label is not None:
-                    groups.append({
-                        'label': '',
-                        'index': len(groups),
-                        'choices': [],
-                        '_next_idx': next_idx,
-                        })
-                groups[-1]['choices'].append(option)
-                next_idx += 1
+        groups = [
+            {
+                'label': label,
+                'index': idx,
+                'choices': choices,
+                '_range': (start, end),
+            }
+            for idx, (label, start, end, choices) in enumerate(_choice_table(context[STATEVAR], field).groups)
+            ]
 
         if not groups:
             groups.append({
                 'label': '',
                 'index': 0,
-                'choices': [],
-                '_next_idx': 0,
+                'choices': (),
+                '_range': (0, 0),
                 })
 
-        out = []
         context.push()
-        for group in groups:
-            context[self.group_var] = group
-            context[OPTGROUPVAR] = group
-            out.append(self.nodelist.render(context))
-        context.pop()
-
-        return u'\n'.join(out)
+        try:
+            for i, group in enumerate(groups):
+                if i:
+                    yield u'\n'
+                context[self.group_var] = group
+                context[OPTGROUPVAR] = group
+                for chunk in _stream_nodelist(self.nodelist, context):
+                    yield chunk
+        finally:
+            context.pop()
 
     def __repr__(self):
         return '<FieldChoiceGroupsNode node: {0}>'.format(self.group_var)
@@ -689,24 +2388,227 @@ class HiddenFieldsNode(template.Node):
         if FORMVAR not in context:
             raise FormTagError("Hidden field tag must be nested in a form tag!")
 
-        if context[STATEVAR]['render']:
-            return u'\n'.join([unicode(f) for f in context[FORMVAR].hidden_fields()])
+        if context[STATEVAR].render:
+            return u'\n'.join([str(f) for f in context[FORMVAR].hidden_fields()])
         else:
             return u''
 
     def __repr__(self):
         return '<Hidden fields node>'
 
+class FieldSwitchNode(template.Node):
+    """
+    Render one of several blocks depending on the widget class of a field.
+
+    The case blocks are looked up by widget class name from a dictionary
+    built at compile time. The result of the lookup is cached per widget
+    class. If MRO matching is enabled, the names of the widget's base
+    classes are tried too, so subclassed widgets match the cases of their
+    parents.
+    """
+
+    def __init__(self, field, cases, default, mro):
+        """
+        Arguments:
+        field   -- filter expression for the field, or None to use the
+                   current field
+        cases   -- list of (widget names, nodelist) tuples
+        default -- nodelist to render if no case matches, or None
+        mro     -- match the names of the widget's base classes too
+        """
+        self.field = field
+        self.nodelists = [nodelist for (names, nodelist) in cases]
+        if default is not None:
+            self.nodelists.append(default)
+        self.default = default
+        self.mro = mro
+
+        self._dispatch = {}
+        for idx, (names, nodelist) in enumerate(cases):
+            for name in names:
+                self._dispatch.setdefault(name, idx)
+
+        self._by_class = {}
+
+    def get_nodes_by_type(self, nodetype):
+        nodes = []
+        if isinstance(self, nodetype):
+            nodes.append(self)
+        for nodelist in self.nodelists:
+            nodes.extend(nodelist.get_nodes_by_type(nodetype))
+        return nodes
+
+    def branch(self, context):
+        """
+        Return the nodelist to render for the field, or None.
+        """
+        if self.field is None:
+            if CURFIELDVAR not in context:
+                raise FormTagError("Field_switch tag must be nested in a field tag!")
+            field = context[CURFIELDVAR]
+        else:
+            field = self.field.resolve(context)
+
+        widget_class = type(field.field.widget)
+        try:
+            idx = self._by_class[widget_class]
+        except KeyError:
+            classes = widget_class.__mro__ if self.mro else (widget_class,)
+            idx = None
+            for cls in classes:
+                idx = self._dispatch.get(cls.__name__)
+                if idx is not None:
+                    break
+            self._by_class[widget_class] = idx
+
+        if idx is None:
+            return self.default
+        return self.nodelists[idx]
+
+    def render(self, context):
+        nodelist = self.branch(context)
+        if nodelist is None:
+            return u''
+        return nodelist.render(context)
+
+    def __repr__(self):
+        return '<FieldSwitchNode node: {0}>'.format(' '.join(sorted(self._dispatch)))
+
+class FormsetNode(FormNode):
+    """
+    Container node for the fields of each form in a formset.
+
+    The gathering pass is run only once, and the field assignment
+    is planned once for the formset's form class.
+    """
+    def __init__(self, nodelist, formset, formvar, with_empty):
+        super(FormsetNode, self).__init__(nodelist, formset)
+        self.formvar = formvar
+        self.with_empty = with_empty
+
+    def stream(self, context):
+        """
+        Render the formset, yielding the output in chunks.
+        """
+        formset = context.get(self.form, None)
+        if formset is None or _in_gathering_pass(context):
+            return
+
+        yield u'\n'.join([str(f) for f in formset.management_form])
+
+        forms = list(formset.forms)
+        if self.with_empty:
+            forms.append(formset.empty_form)
+
+        if not forms:
+            return
+
+        stats = RenderStats() if form_rendered.receivers else None
+
+        context.push()
+        try:
+            # Gather fields using the first form
+            context[self.formvar] = forms[0]
+            context[FORMVAR] = forms[0]
+            gathered = context[STATEVAR] = _RenderState()
+
+            start = time.perf_counter()
+            _gather(self._gather_nodes, context)
+            if stats is not None:
+                stats.gather_time = time.perf_counter() - start
+
+            # Assign and render each form
+            for form in forms:
+                state = _RenderState()
+                state.tags = gathered.tags
+                state.nodes = gathered.nodes
+                state.parents = gathered.parents
+                state.dynamic = gathered.dynamic
+                state.stats = stats
+
+                start = time.perf_counter()
+                self._assign(form, state)
+                _prefetch_choices(state)
+                if stats is not None:
+                    stats.assign_time += time.perf_counter() - start
+                    _count_assigned(state)
+
+                state.render = True
+                context[self.formvar] = form
+                context[FORMVAR] = form
+                context[STATEVAR] = state
+
+                yield u'\n'
+                start = time.perf_counter()
+                for chunk in _stream_nodelist(self.nodelist, context):
+                    yield chunk
+                if stats is not None:
+                    stats.render_time += time.perf_counter() - start
+
+        finally:
+            context.pop()
+
+        if stats is not None:
+            form_rendered.send(sender=type(self), node=self, form=formset, stats=stats)
+
+    def __repr__(self):
+        return '<Formset node: {0}>'.format(self.form)
+
+_STREAMING_NODES = (FormNode, FieldNode, FieldChoicesNode, FieldChoiceGroupsNode)
+
 @register.tag
 def form(parser, token):
+    tokens = token.split_contents()
+
+    cache = False
+    if len(tokens) > 2 and tokens[-1] == 'cache':
+        cache = True
+        tokens = tokens[:-1]
+
+    form_class = None
+    if len(tokens) == 4 and tokens[2] == 'using':
+        path = parser.compile_filter(tokens[3])
+        if isinstance(path.var, template.Variable) or path.filters:
+            raise FormTagError("form class path must be a string literal")
+        try:
+            form_class = import_string(path.var)
+        except ImportError as e:
+            raise FormTagError("Could not import form class {0}: {1}".format(path.var, e))
+        tokens = tokens[:2]
+
     try:
-        tag_name, form_var = token.split_contents()
+        tag_name, form_var = tokens
         nodelist = parser.parse(('endform',))
         parser.delete_first_token()
     except ValueError:
         raise FormTagError("{0} tag requires a single argument".format(token.contents.split()[0]))
 
-    return FormNode(nodelist, form_var)
+    return FormNode(nodelist, form_var, cache, form_class)
+
+@register.tag
+def formset(parser, token):
+    tokens = token.split_contents()
+    if len(tokens) < 2:
+        raise FormTagError("{0} tag requires at least one argument".format(tokens[0]))
+
+    formset_var = tokens[1]
+    options = tokens[2:]
+
+    with_empty = False
+    if options and options[-1] == 'empty_form':
+        with_empty = True
+        options = options[:-1]
+
+    formvar = 'form'
+    if len(options) == 2 and options[0] == 'as':
+        formvar = options[1]
+    elif options:
+        raise FormTagError("formset tag syntax: {% formset <formset> [as <form var>] [empty_form] %}")
+
+    nodelist = parser.parse(('endformset',))
+    parser.delete_first_token()
+
+    return FormsetNode(nodelist, formset_var, formvar, with_empty)
 
 @register.tag
 def field(parser, token):
@@ -717,10 +2619,26 @@ def field(parser, token):
             fieldvar = tokens[-1]
             tokens = tokens[:-2]
 
+    cache = False
+    if tokens and tokens[-1] == 'cache':
+        cache = True
+        tokens = tokens[:-1]
+
     nodelist = parser.parse(('endfield',))
     parser.delete_first_token()
 
-    return FieldNode(nodelist, fieldvar, [parser.compile_filter(t) for t in tokens])
+    matchers = []
+    for t in tokens:
+        m = parser.compile_filter(t)
+        if not isinstance(m.var, template.Variable) and not m.filters:
+            # String literal: parse once at compile time
+            m = parse_matcher(m.var)
+        matchers.append(m)
+
+    if not matchers:
+        matchers.append(AnyMatcher())
+
+    return FieldNode(nodelist, fieldvar, matchers, cache)
 
 @register.tag
 def if_field(parser, token):
@@ -779,6 +2697,208 @@ def field_choice_groups(parser, token):
 def hidden_fields(parser, token):
     return HiddenFieldsNode()
 
+@register.tag
+def field_switch(parser, token):
+    tokens = token.split_contents()[1:]
+
+    mro = False
+    if tokens and tokens[-1] == 'mro':
+        mro = True
+        tokens = tokens[:-1]
+
+    if len(tokens) > 1:
+        raise FormTagError("field_switch takes at most 2 arguments: [<field>] [mro]")
+
+    field = parser.compile_filter(tokens[0]) if tokens else None
+
+    nodelist = parser.parse(('case', 'default', 'endfield_switch'))
+    if any(not isinstance(n, TextNode) or n.s.strip() for n in nodelist):
+        raise FormTagError("field_switch may only contain case and default blocks")
+
+    cases = []
+    default = None
+    token = parser.next_token()
+    while token.contents != 'endfield_switch':
+        if default is not None:
+            raise FormTagError("default must be the last block of field_switch")
+
+        bits = token.split_contents()
+        nodelist = parser.parse(('case', 'default', 'endfield_switch'))
+        if bits[0] == 'case':
+            if len(bits) < 2:
+                raise FormTagError("case requires at least one widget name")
+            names = []
+            for bit in bits[1:]:
+                name = parser.compile_filter(bit)
+                if isinstance(name.var, template.Variable) or name.filters:
+                    raise FormTagError("case widget names must be string literals")
+                names.extend(name.var.split())
+            cases.append((names, nodelist))
+        else:
+            default = nodelist
+        if field is None and nodelist.get_nodes_by_type(FieldNode):
+            # The case can't be chosen before the fields are assigned
+            raise FormTagError("field_switch without a field may not contain field tags")
+        token = parser.next_token()
+
+    return FieldSwitchNode(field, cases, default, mro)
+
+def _widget_text(value):
+    """
+    Format a value like a variable in a widget template.
+    """
+    value = localize(template_localtime(value))
+    if not issubclass(type(value), str):
+        value = str(value)
+    return conditional_escape(value)
+
+def _widget_format(value):
+    """
+    Format a value like the stringformat:'s' filter in a widget template.
+    """
+    if isinstance(value, tuple):
+        value = str(value)
+    try:
+        text = '%s' % value
+    except (ValueError, TypeError):
+        return u''
+    return text if isinstance(value, SafeData) else conditional_escape(text)
+
+def _widget_attrs(attrs):
+    """
+    Render widget attributes like the attrs.html widget template.
+    """
+    out = []
+    for name, value in attrs.items():
+        if value is not False:
+            out.append(u' ')
+            out.append(_widget_text(name))
+            if value is not True:
+                out.append(u'="{0}"'.format(_widget_format(value)))
+    return u''.join(out)
+
+def _render_input(widget):
+    value = widget['value']
+    return u'<input type="{0}" name="{1}"{2}{3}>'.format(
+        _widget_text(widget['type']),
+        _widget_text(widget['name']),
+        u'' if value is None else u' value="{0}"'.format(_widget_format(value)),
+        _widget_attrs(widget['attrs']))
+
+def _render_textarea(widget):
+    value = widget['value']
+    return u'<textarea name="{0}"{1}>\n{2}</textarea>'.format(
+        _widget_text(widget['name']),
+        _widget_attrs(widget['attrs']),
+        _widget_text(value) if value else u'')
+
+def _render_select(widget):
+    out = [u'<select name="{0}"{1}>'.format(
+        _widget_text(widget['name']), _widget_attrs(widget['attrs']))]
+    for group_name, group_choices, group_index in widget['optgroups']:
+        if group_name:
+            out.append(u'\n  <optgroup label="{0}">'.format(_widget_text(group_name)))
+        for option in group_choices:
+            if option['template_name'] != _SELECT_OPTION_TEMPLATE:
+                return None
+            out.append(u'\n  <option value="{0}"{1}>{2}</option>\n'.format(
+                _widget_format(option['value']),
+                _widget_attrs(option['attrs']),
+                _widget_text(option['label'])))
+        if group_name:
+            out.append(u'\n  </optgroup>')
+    out.append(u'\n</select>')
+    return u''.join(out)
+
+_SELECT_OPTION_TEMPLATE = 'django/forms/widgets/select_option.html'
+
+# Built-in widgets rendered by fast_widget, with their default templates
+# and the templates these include
+_FAST_WIDGETS = dict((widget, (template_name, builder, includes)) for (widget, template_name, builder, includes) in (
+    (forms.TextInput, 'django/forms/widgets/text.html', _render_input, ('input', 'attrs')),
+    (forms.NumberInput, 'django/forms/widgets/number.html', _render_input, ('input', 'attrs')),
+    (forms.EmailInput, 'django/forms/widgets/email.html', _render_input, ('input', 'attrs')),
+    (forms.URLInput, 'django/forms/widgets/url.html', _render_input, ('input', 'attrs')),
+    (forms.PasswordInput, 'django/forms/widgets/password.html', _render_input, ('input', 'attrs')),
+    (forms.HiddenInput, 'django/forms/widgets/hidden.html', _render_input, ('input', 'attrs')),
+    (forms.DateInput, 'django/forms/widgets/date.html', _render_input, ('input', 'attrs')),
+    (forms.DateTimeInput, 'django/forms/widgets/datetime.html', _render_input, ('input', 'attrs')),
+    (forms.TimeInput, 'django/forms/widgets/time.html', _render_input, ('input', 'attrs')),
+    (forms.CheckboxInput, 'django/forms/widgets/checkbox.html', _render_input, ('input', 'attrs')),
+    (forms.Textarea, 'django/forms/widgets/textarea.html', _render_textarea, ('attrs',)),
+    (forms.Select, 'django/forms/widgets/select.html', _render_select, ('attrs', 'select_option')),
+    (forms.NullBooleanSelect, 'django/forms/widgets/select.html', _render_select, ('attrs', 'select_option')),
+    (forms.SelectMultiple, 'django/forms/widgets/select.html', _render_select, ('attrs', 'select_option')),
+    ))
+
+_BUILTIN_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(forms.__file__)), 'templates')
+
+# Per form renderer and template name: is the template Django's own?
+_builtin_templates = weakref.WeakKeyDictionary()
+
+def _is_builtin_template(renderer, template_name):
+    """
+    Return true if the renderer resolves the template name to the
+    template shipped with Django.
+    """
+    try:
+        known = _builtin_templates[renderer]
+    except KeyError:
+        known = _builtin_templates[renderer] = {}
+    except TypeError:
+        return False
+
+    builtin = known.get(template_name)
+    if builtin is None:
+        try:
+            origin = renderer.get_template(template_name).origin.name
+        except Exception:
+            origin = ''
+        builtin = known[template_name] = os.path.abspath(origin).startswith(_BUILTIN_TEMPLATE_DIR)
+    return builtin
+
+def _fast_render(field):
+    """
+    Render the widget of a bound field without the widget templates, like
+    BoundField.as_widget. Returns None if this is not possible.
+    """
+    widget = field.field.widget
+    try:
+        template_name, builder, includes = _FAST_WIDGETS[type(widget)]
+    except KeyError:
+        return None
+
+    renderer = field.form.renderer
+    if not isinstance(renderer, DjangoTemplates) or widget.template_name != template_name:
+        return None
+    if not _is_builtin_template(renderer, template_name) or not all(
+            _is_builtin_template(renderer, 'django/forms/widgets/{0}.html'.format(name))
+            for name in includes):
+        return None
+
+    if field.field.localize:
+        widget.is_localized = True
+    attrs = field.build_widget_attrs({}, widget)
+    if field.auto_id and 'id' not in widget.attrs:
+        attrs.setdefault('id', field.auto_id)
+
+    context = widget.get_context(field.html_name, field.value(), attrs)
+    return builder(context['widget'])
+
+@register.filter
+def fast_widget(field):
+    """
+    Filter: Render the widget of the given field, like {{ field }}.
+
+    The common built-in widgets are rendered without their templates.
+    """
+    html = _fast_render(field)
+    if html is None:
+        return mark_safe(str(field))
+    if field.field.show_hidden_initial:
+        html += field.as_hidden(only_initial=True)
+    return mark_safe(html)
+
 @register.filter
 def widget_name(field, match_names=None):
     """
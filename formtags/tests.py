@@ -1,13 +1,28 @@
 """
 Unit tests for the form tag library.
 """
-from django.template import Template, Context
+from django.template import Template, Context, Engine
 from django import forms
+from django.forms.formsets import formset_factory
+from django.test.utils import override_settings
+from django.utils import timezone, translation
+from django.utils.translation import get_language, gettext_lazy
 
-from .templatetags.forms import FormTagError
+from .layout import Layout
+from .signals import form_rendered
+from .templatetags.forms import FormTagError, FieldNode, AnyMatcher, \
+        OptionalNameMatcher, _get_matcher, _choice_table_cache, _choices_key, stream_template, \
+        render_form_fragment, render_form_map, render_form_patches, fast_widget, _fast_render
 
+import datetime
 import unittest;
 import re
+import threading
+
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
 
 class FormtagTests(unittest.TestCase):
     def test_catchall_only(self):
@@ -50,6 +65,14 @@ class FormtagTests(unittest.TestCase):
             """textfield2,numberfield,numberfield2,EXPLICIT"""
             )
 
+    def test_missing_form(self):
+        """
+        A form tag whose form is missing renders nothing.
+        """
+        template = "{% load forms %}a{% form nope %}{% field %}X{% endfield %}{% endform %}b"
+        self.assertEquals(self._render(template), 'ab')
+        self.assertEquals(self._render(template, nope=None), 'ab')
+
     def test_missing_field(self):
         """
         An exception should be thrown if a field is not found
@@ -235,6 +258,66 @@ class FormtagTests(unittest.TestCase):
             True,
             """)
 
+    def test_field_switch(self):
+        """
+        The field_switch tag renders the block matching the widget class,
+        optionally taking the widget's base classes into account.
+        """
+        self.__test(
+            SimpleForm(),
+            # Template:
+            """
+            {% field %}{% field_switch %}
+            {% case "Textarea" %}AREA,
+            {% case "TextInput" "PasswordInput" %}TEXT,
+            {% default %}OTHER,
+            {% endfield_switch %}{% endfield %}
+            """,
+            # Expected
+            """
+            TEXT,TEXT,OTHER,OTHER,
+            """)
+
+        # Without mro, NumberInput does not match the TextInput case
+        self.__test(
+            SimpleForm(),
+            # Template:
+            """
+            {% field "numberfield" %}{% field_switch %}{% case "Input" %}INPUT{% endfield_switch %},{% endfield %}
+            {% field "numberfield2" %}{% field_switch field mro %}{% case "Input" %}INPUT{% endfield_switch %}{% endfield %}
+            {% field %}{% endfield %}
+            """,
+            # Expected
+            """
+            ,INPUT
+            """)
+
+        # Only the field tags of the chosen case are matched
+        self.__test(
+            SimpleForm(),
+            # Template:
+            """
+            {% field_switch form.textfield %}
+            {% case "TextInput" %}{% field "numberfield" %}{{ field.name }}{% endfield %}
+            {% default %}{% field "numberfield2" %}{{ field.name }}{% endfield %}
+            {% endfield_switch %},
+            {% field %}{{ field.name }},{% endfield %}
+            """,
+            # Expected
+            """
+            numberfield,textfield,textfield2,numberfield2,
+            """)
+
+        with self.assertRaises(FormTagError):
+            Template("{% load forms %}{% field_switch %}X{% case 'A' %}{% endfield_switch %}")
+
+        # The case of the current field is only known in the render pass
+        with self.assertRaises(FormTagError):
+            Template(
+                "{% load forms %}{% field %}{% field_switch %}{% case 'Textarea' %}"
+                "{% field 'x' %}{% endfield %}{% default %}{% field 'y' %}{% endfield %}"
+                "{% endfield_switch %}{% endfield %}")
+
     def test_choice_field(self):
         """
         Test the field_choices iterator tag
@@ -256,6 +339,53 @@ class FormtagTests(unittest.TestCase):
             'C'='Choice 3'(False),
             """)
 
+    def test_choice_field_multiple(self):
+        """
+        Selected values of a multiple choice field are matched exactly
+        and compared as strings.
+        """
+        self.__test(
+            MultiChoiceForm(initial={'choicefield': [1, 'AB']}),
+            # Template:
+            """
+            {% field "choicefield" %}
+            {% field_choices %}{{ choice.value }}={{ choice.selected }},{% endfield_choices %}
+            {% endfield %}
+            """,
+            # Expected
+            """
+            A=False,AB=True,B=False,1=True,
+            """)
+
+        self.__test(
+            ChoiceForm(initial={'choicefield': 'AB'}),
+            # Template:
+            """
+            {% field "choicefield" %}
+            {% field_choices %}{{ choice.value }}={{ choice.selected }},{% endfield_choices %}
+            {% endfield %}
+            """,
+            # Expected
+            """
+            A=False,B=False,C=False,
+            """)
+
+        # Submitted data and field initial values are selected
+        class InitialChoiceForm(ChoiceForm):
+            choicefield = forms.ChoiceField(choices=ChoiceForm.base_fields['choicefield'].choices,
+                initial='B')
+
+        template = """
+            {% field "choicefield" %}
+            {% field_choices %}{{ choice.value }}={{ choice.selected }},{% endfield_choices %}
+            {% endfield %}
+            """
+        self.__test(InitialChoiceForm(), template, "A=False,B=True,C=False,")
+        self.__test(ChoiceForm(data={'choicefield': 'A'}), template, "A=True,B=False,C=False,")
+        self.__test(
+            MultiChoiceForm(data={'choicefield': ['B', 'AB']}), template,
+            "A=False,AB=True,B=True,1=False,")
+
     def test_optgroups_flat(self):
         """
         A choice_field will flatten option groups.
@@ -312,6 +442,130 @@ class FormtagTests(unittest.TestCase):
             endG.
             """)
 
+    def test_choice_snapshot(self):
+        """
+        Lazy choices are evaluated only once per form render.
+        """
+        counter = _Counter()
+
+        def choices():
+            counter.hit()
+            return [('0', 'C0'), ('1', 'C1'), ('G', [('2', 'C2')]), ('3', 'C3'), ('4', 'C4')]
+
+        class LazyChoiceForm(forms.Form):
+            choicefield = forms.ChoiceField(choices=choices)
+
+        self.__test(
+            LazyChoiceForm(),
+            # Template:
+            """
+            {% field "choicefield" %}
+            {% field_choice_groups %}
+            G{{ optgroup.index }}:{{ optgroup.label }};
+            {% field_choices %}{{ choice.value }}{% endfield_choices %}
+            {% endfield_choice_groups %}
+            {% field_choices %}{{ choice.value }}{% endfield_choices %}
+            {% endfield %}
+            """,
+            # Expected:
+            """
+            G0:;01
+            G1:G;2
+            G2:;34
+            01234
+            """)
+        self.assertEquals(counter.count, 1)
+
+    def test_choice_prefetch(self):
+        """
+        Lazy choices of fields rendered with choice tags are evaluated on
+        the prefetch threads before the render pass.
+        """
+        threads = []
+
+        def choices():
+            threads.append(threading.current_thread())
+            return [('0', 'C0'), ('1', 'C1')]
+
+        class LazyChoiceForm(forms.Form):
+            first = forms.ChoiceField(choices=choices)
+            second = forms.ChoiceField(choices=choices)
+            widget = forms.ChoiceField(choices=choices)
+
+        template = """
+            {% field "widget" %}W,{% endfield %}
+            {% field %}{% field_choices %}{{ choice.value }}{% endfield_choices %},{% endfield %}
+            """
+
+        with override_settings(FORMTAGS_PREFETCH_THREADS=2):
+            self.__test(LazyChoiceForm(), template, "W,01,01,")
+        self.assertEquals(len(threads), 2)
+        self.assertTrue(all(t is not threading.current_thread() for t in threads))
+
+        # Disabled by default
+        del threads[:]
+        self.__test(LazyChoiceForm(), template, "W,01,01,")
+        self.assertEquals(threads, [threading.current_thread()] * 2)
+
+        # The language and time zone of the rendering thread are active
+        # in the prefetch threads
+        def locale_choices():
+            return [(get_language(), str(timezone.get_current_timezone()))]
+
+        class LocaleChoiceForm(forms.Form):
+            first = forms.ChoiceField(choices=locale_choices)
+            second = forms.ChoiceField(choices=locale_choices)
+
+        template = """
+            {% field %}{% field_choices %}{{ choice.value }}:{{ choice.label }}{% endfield_choices %},{% endfield %}
+            """
+        with override_settings(FORMTAGS_PREFETCH_THREADS=2), translation.override('fi'), \
+                timezone.override('Europe/Helsinki'):
+            self.__test(
+                LocaleChoiceForm(), template, "fi:Europe/Helsinki,fi:Europe/Helsinki,")
+
+    def test_choice_table_cache(self):
+        """
+        Static choice lists are shared between renders.
+        """
+        for i in range(2):
+            self.__test(
+                ChoiceForm(),
+                # Template:
+                """
+                {% field "choicefield" %}
+                {% field_choices %}{{ choice.id }}={{ choice.label }},{% endfield_choices %}
+                {% endfield %}
+                """,
+                # Expected:
+                """
+                id_choicefield_0=Choice1,id_choicefield_1=Choice2,id_choicefield_2=Choice3,
+                """)
+
+        choices = ChoiceForm().fields['choicefield'].choices
+        table = _choice_table_cache.get(_choices_key(choices))
+        self.assertEquals(table.values, ('A', 'B', 'C'))
+        self.assertEquals(table.groups, (('', 0, 3, tuple(choices)),))
+
+        # Equal values of different types don't share tables
+        class TypedForm(forms.Form):
+            def __init__(self, choices):
+                super(TypedForm, self).__init__()
+                self.fields['choicefield'] = forms.TypedChoiceField(choices=choices)
+
+        for choices, expected in (
+                (((True, 'Yes'), (False, 'No')), 'True,False,'),
+                (((1, 'Yes'), (0, 'No')), '1,0,'),
+                (((1.0, 'Yes'), (0.0, 'No')), '1.0,0.0,')):
+            self.__test(
+                TypedForm(choices),
+                """
+                {% field "choicefield" %}
+                {% field_choices %}{{ choice.value }},{% endfield_choices %}
+                {% endfield %}
+                """,
+                expected)
+
     def test_nested_field(self):
         """
         Test the nesting of two form fields.
@@ -336,6 +590,425 @@ class FormtagTests(unittest.TestCase):
             choicefield
             """)
 
+    def test_stream_template(self):
+        """
+        Streaming produces the same output as rendering, in chunks.
+        """
+        tpl = Template(
+            "{% load forms %}<form>{% form form %}"
+            "{% field %}{{ field.name }},{% endfield %}"
+            "{% field \"choicefield\" %}{% field_choices %}{{ choice.value }};{% endfield_choices %}{% endfield %}"
+            "{% endform %}</form>")
+
+        chunks = list(stream_template(tpl, {'form': ChoiceForm2()}))
+        self.assertTrue(len(chunks) > 5)
+        self.assertEquals(
+            ''.join(chunks),
+            tpl.render(Context({'form': ChoiceForm2()})))
+        self.assertEquals(''.join(chunks), "<form>textfield,A;B;</form>")
+
+    def test_render_form_fragment(self):
+        """
+        A single field can be rendered without rendering the whole form.
+        """
+        counter = _Counter()
+        tpl = Template("""{% load forms %}
+            <form>{{ counter.hit }}{% form form %}
+            {% field "textfield" %}[{{ field.name }}
+              {% field "numberfield" %}<{{ field.name }}>{% endfield %}
+              {% field "numberfield2" %}<{{ field.name }}>{% endfield %}]
+            {% endfield %}
+            {% field %}{{ field.name }},{% endfield %}
+            {% endform %}</form>
+            {% form other %}{% field %}{{ other.prefix }}:{{ field.name }}{% endfield %}{% endform %}""")
+
+        fragment = lambda name, **kwargs: _strip(
+            render_form_fragment(tpl, SimpleForm(), name, {'counter': counter}, **kwargs))
+
+        self.assertEquals(fragment('textfield2'), 'textfield2,')
+        self.assertEquals(fragment('textfield'), '[textfield]')
+        self.assertEquals(fragment('numberfield2'), '[textfield<numberfield2>]')
+        self.assertEquals(counter.count, 0)
+
+        self.assertEquals(
+            _strip(render_form_fragment(tpl, SimpleForm(prefix='p'), 'textfield2', form_name='other')),
+            'p:textfield2')
+
+        with self.assertRaises(FormTagError):
+            fragment('hidden1')
+
+    def test_render_form_patches(self):
+        """
+        Only the fields that changed are re-rendered, as patches to the
+        previous output.
+        """
+        tpl = Template("""{% load forms %}<form>{% form form %}
+            {% field "textfield" %}<p>{{ field.value }}
+              {% field "numberfield" %}<i>{{ field.value }}{{ field.errors|length }}</i>{% endfield %}</p>
+            {% endfield %}
+            {% field %}<b>{{ field.value }}{{ field.errors|length }}</b>{% endfield %}
+            {% endform %}</form>""")
+
+        data = {'textfield': 'a', 'textfield2': 'b', 'numberfield': '1', 'numberfield2': '2'}
+        initial = dict(data, numberfield=1, numberfield2=2)
+        form = SimpleForm(initial=initial, data=data)
+
+        previous = render_form_map(tpl, form)
+        self.assertEquals(previous.html, tpl.render(Context({'form': form})))
+        self.assertEquals(previous.spans['textfield'], previous.spans['numberfield'])
+        start, end = previous.spans['textfield2']
+        self.assertEquals(previous.html[start:end], '<b>b0</b>')
+
+        changed = dict(data, numberfield='x', numberfield2='3')
+        form = SimpleForm(initial=initial, data=changed)
+        patches, current = render_form_patches(tpl, form, previous)
+
+        self.assertEquals(
+            [previous.html[start:end] for (start, end, html) in patches],
+            [previous.html[slice(*previous.spans['textfield'])], '<b>20</b>'])
+        self.assertEquals(
+            [_strip(html) for (start, end, html) in patches],
+            ['<p>a<i>x1</i></p>', '<b>30</b>'])
+
+        self.assertEquals(current.html, tpl.render(Context({'form': form})))
+        for name in data:
+            self.assertEquals(
+                current.html[slice(*current.spans[name])],
+                render_form_fragment(tpl, form, 'numberfield' if name == 'textfield' else name))
+
+        # Nothing changed
+        patches, current = render_form_patches(tpl, SimpleForm(initial=initial, data=data), previous)
+        self.assertEquals(patches, [])
+
+    def test_render_form_map_data(self):
+        """
+        Rendered data looking like span markers neither changes the output
+        nor the spans.
+        """
+        tpl = Template("""{% load forms %}{{ stray }}<form>{% form form %}
+            {% field "textfield" %}<p>{{ field.value }}</p>{% endfield %}
+            {% field %}<b>{{ field.value }}</b>{% endfield %}
+            {% endform %}</form>{{ stray2 }}""")
+
+        data = {
+            'textfield': 'a\x00\x02', 'textfield2': '\x00textfield\x01b',
+            'numberfield': '1', 'numberfield2': '2', 'hidden1': '\x00\x02\x00x\x01'}
+        form = SimpleForm(data=data)
+        context = {'form': form, 'stray': '\x00\x02', 'stray2': '\x00y\x01'}
+
+        current = render_form_map(tpl, form, context)
+        self.assertEquals(current.html, tpl.render(Context(context)))
+        self.assertEquals(
+            [current.html[slice(*current.spans[name])] for name in ('textfield', 'textfield2')],
+            ['<p>a\x00\x02</p>', '<b>\x00textfield\x01b</b>'])
+
+    def test_layout(self):
+        """
+        Layouts assign fields to renderers with the precedence semantics
+        of the field tags.
+        """
+        from django.utils.html import format_html
+
+        layout = Layout([
+            (None, lambda f: format_html('<p>{0}</p>', f.name)),
+            ("*2", lambda f: f.name.upper()),
+            (("numberfield", "missing?"), lambda f: '<{0}>'.format(f.name)),
+            ], separator=',')
+
+        self.assertEquals(
+            layout.render(SimpleForm(prefix='p')),
+            '<p>textfield</p>,TEXTFIELD2,NUMBERFIELD2,&lt;numberfield&gt;,'
+            '<input type="hidden" name="p-hidden1" id="id_p-hidden1">')
+        self.assertEquals(
+            [[f.name for f in fields] for (renderer, fields) in layout.assign(SimpleForm())],
+            [['textfield'], ['textfield2', 'numberfield2'], ['numberfield']])
+
+        with self.assertRaises(FormTagError):
+            Layout([("textfield", None)])
+        with self.assertRaises(FormTagError):
+            Layout([("textfield", str)], hidden_fields=False).render(SimpleForm())
+
+    def test_fast_widget(self):
+        """
+        The fast_widget filter renders fields exactly like Django's widget
+        templates, and falls back to them for other widgets.
+        """
+        self.__test(
+            ChoiceForm2(),
+            # Template:
+            """{% field %}{{ field|fast_widget }}{% endfield %}""",
+            # Expected:
+            """<input type="text" name="textfield" required id="id_textfield">
+            <select name="choicefield" id="id_choicefield">
+              <option value="A">Choice 1</option>
+              <option value="B">Choice 2</option>
+            </select>""")
+
+    def test_fast_widget_parity(self):
+        """
+        Parity of fast_widget with Django's rendering across widgets,
+        attributes, values and errors.
+        """
+        data = {
+            'text': 'a "quoted" <value>', 'number': '1234.5', 'email': 'x@example.com',
+            'url': 'http://example.com/?a=1&b=2', 'password': 'secret',
+            'date': '2020-01-02', 'stamp': '2020-01-02 03:04', 'time': '03:04',
+            'check': 'on', 'area': '<b>text</b>\nline', 'select': '2', 'grouped': 'b',
+            'null': 'true', 'multiple': ['1', '3'], 'radio': '1', 'custom': 'c',
+            'lazy': 'x', 'initial-text2': 'old', 'text2': 'new', 'hidden': '5',
+            }
+        bad = dict(data, number='x', email='bad', date='never', select='9')
+
+        for form in (ParityForm(), ParityForm(prefix='p', auto_id='f_%s'),
+                ParityForm(data), ParityForm(bad), ParityForm(auto_id=False)):
+            for field in form:
+                self.assertEquals(fast_widget(field), str(field), field.name)
+
+        with override_settings(USE_THOUSAND_SEPARATOR=True):
+            form = ParityForm(data)
+            self.assertEquals(fast_widget(form['number']), str(form['number']))
+
+        fast = [f.name for f in ParityForm() if _fast_render(f) is not None]
+        self.assertEquals(
+            set(ParityForm.base_fields) - set(fast),
+            set(['radio', 'custom', 'overridden']))
+
+    def test_formset(self):
+        """
+        Each form of a formset is rendered with the same field tags.
+        """
+        FormSet = formset_factory(ChoiceForm2, extra=2, can_delete=True, can_delete_extra=False)
+        formset = FormSet(initial=[{'textfield': 'x'}])
+
+        out = _render(
+            """{% load forms %}{% formset formset as row empty_form %}
+            [{{ row.prefix }}:{% field "choicefield" %}{{ field.name }}{% endfield %}
+            {% field "DELETE?" %}D{% endfield %}
+            {% field %}{{ field.name }}{% endfield %}
+            {% hidden_fields %}]
+            {% endformset %}""",
+            formset=formset)
+
+        self.assertEquals(
+            _strip(re.sub(r'<input[^>]*name="([^"]*)"[^>]*>', r'<\1>', out)),
+            "<form-TOTAL_FORMS><form-INITIAL_FORMS><form-MIN_NUM_FORMS><form-MAX_NUM_FORMS>"
+            "[form-0:choicefieldDtextfield]"
+            "[form-1:choicefieldtextfield]"
+            "[form-2:choicefieldtextfield]"
+            "[form-__prefix__:choicefieldtextfield]"
+            )
+
+    def test_field_cache(self):
+        """
+        Cached field tags render their content only once per field value.
+        """
+        for cache in (None, 'default'):
+            with override_settings(FORMTAGS_CACHE=cache):
+                counter = _Counter()
+                tpl = Template(
+                    "{% load forms %}{% form form %}"
+                    "{% field \"text*\" cache %}{{ field.name }}={{ counter.hit }},{% endfield %}"
+                    "{% field %}{% endfield %}"
+                    "{% endform %}")
+
+                def render(form):
+                    return _strip(tpl.render(Context({'form': form, 'counter': counter})))
+
+                self.assertEquals(render(SimpleForm()), "textfield=1,textfield2=2,")
+                self.assertEquals(render(SimpleForm()), "textfield=1,textfield2=2,")
+                self.assertEquals(
+                    render(SimpleForm(initial={'textfield2': 'x'})),
+                    "textfield=1,textfield2=3,")
+
+        # Forms sharing the block, and per-instance choices, get their own
+        # cache entries. Lazy choices are not cached.
+        class LabelForm(forms.Form):
+            textfield = forms.CharField(label='Other')
+
+        class ChoicesForm(ChoiceForm):
+            def __init__(self, choices):
+                super(ChoicesForm, self).__init__()
+                self.fields['choicefield'].choices = choices
+
+        counter = _Counter()
+        tpl = Template(
+            "{% load forms %}{% form form %}{% field cache %}{{ field.label }}:"
+            "{% field_choices %}{{ choice.value }}{% endfield_choices %}{{ counter.hit }}"
+            "{% endfield %}{% endform %}")
+        render = lambda form: _strip(tpl.render(Context({'form': form, 'counter': counter})))
+
+        self.assertEquals(render(ChoicesForm([('A', 'A')])), 'Choicefield:A1')
+        self.assertEquals(render(ChoicesForm([('A', 'A')])), 'Choicefield:A1')
+        self.assertEquals(render(ChoicesForm([('B', 'B')])), 'Choicefield:B2')
+        self.assertEquals(render(ChoicesForm(lambda: [('C', 'C')])), 'Choicefield:C3')
+        self.assertEquals(render(ChoicesForm(lambda: [('C', 'C')])), 'Choicefield:C4')
+
+        tpl = Template(
+            "{% load forms %}{% form form %}{% field \"textfield\" cache %}{{ field.label }}"
+            "{% endfield %}{% field %}{% endfield %}{% endform %}")
+        self.assertEquals(_strip(tpl.render(Context({'form': SimpleForm()}))), 'Textfield')
+        self.assertEquals(_strip(tpl.render(Context({'form': LabelForm()}))), 'Other')
+
+        # Per-instance field flags are part of the key
+        class LockedForm(SimpleForm):
+            def __init__(self, locked):
+                super(LockedForm, self).__init__()
+                self.fields['textfield'].disabled = locked
+
+        tpl = Template(
+            "{% load forms %}{% form form %}{% field \"textfield\" cache %}{{ field }}"
+            "{% endfield %}{% field %}{% endfield %}{% endform %}")
+        render = lambda form: _strip(tpl.render(Context({'form': form})))
+
+        self.assertNotIn('disabled', render(LockedForm(False)))
+        self.assertIn('disabled', render(LockedForm(True)))
+        self.assertNotIn('disabled', render(LockedForm(False)))
+
+        with self.assertRaises(FormTagError):
+            Template(
+                "{% load forms %}"
+                "{% field cache %}{% field %}{% endfield %}{% endfield %}")
+
+    def test_form_cache(self):
+        """
+        Unbound forms are cached and the CSRF token is substituted.
+        """
+        counter = _Counter()
+        tpl = Template(
+            "{% load forms %}{% form form cache %}{% csrf_token %}"
+            "{% field %}{{ field.name }}={{ counter.hit }},{% endfield %}"
+            "{% endform %}")
+
+        def render(form, token):
+            return tpl.render(Context({'form': form, 'counter': counter, 'csrf_token': token}))
+
+        out = render(ChoiceForm2(), 'token1')
+        self.assertIn('value="token1"', out)
+        self.assertIn('textfield=1,\nchoicefield=2,', out)
+
+        out = render(ChoiceForm2(), 'token2')
+        self.assertIn('value="token2"', out)
+        self.assertIn('textfield=1,\nchoicefield=2,', out)
+
+        # Different initial data
+        out = render(ChoiceForm2(initial={'textfield': 'x'}), 'token3')
+        self.assertIn('textfield=3,\nchoicefield=4,', out)
+
+        # Bound forms are never cached
+        for i in range(2):
+            render(ChoiceForm2(data={}), 'token4')
+        self.assertEquals(counter.count, 8)
+
+        # Callable initial values are evaluated for the key
+        values = _Counter()
+
+        class CallableForm(forms.Form):
+            textfield = forms.CharField(initial=lambda: 'v{0}'.format(values.hit()))
+
+        tpl = Template(
+            "{% load forms %}{% form form cache %}"
+            "{% field %}{{ field.value }}{% endfield %}{% endform %}")
+        self.assertEquals(
+            [tpl.render(Context({'form': CallableForm()})) for i in range(3)],
+            ['v1', 'v2', 'v3'])
+
+        # Per-instance choices are part of the key, forms with lazy choices
+        # are not cached.
+        class ChoicesForm(ChoiceForm):
+            def __init__(self, choices):
+                super(ChoicesForm, self).__init__()
+                self.fields['choicefield'].choices = choices
+
+        tpl = Template(
+            "{% load forms %}{% form form cache %}{% field %}"
+            "{% field_choices %}{{ choice.value }}{% endfield_choices %}"
+            "{% endfield %}{% endform %}")
+        render = lambda form: _strip(tpl.render(Context({'form': form})))
+
+        self.assertEquals(render(ChoicesForm([('A', 'A')])), 'A')
+        self.assertEquals(render(ChoicesForm([('B', 'B')])), 'B')
+
+        lazy = _Counter()
+        choices = lambda: [(str(lazy.hit()), 'C')]
+        self.assertEquals(render(ChoicesForm(choices)), '1')
+        self.assertEquals(render(ChoicesForm(choices)), '2')
+
+    def test_form_rendered_signal(self):
+        """
+        Render statistics are sent after each form.
+        """
+        received = []
+
+        def receiver(sender, node, form, stats, **kwargs):
+            received.append((form, stats))
+
+        form_rendered.connect(receiver)
+        try:
+            form = ChoiceForm2()
+            self.__test(
+                form,
+                # Template:
+                """
+                {% field "choicefield" %}{% field_choices %}{% endfield_choices %}{% endfield %}
+                {% field %}{% endfield %}
+                """,
+                # Expected:
+                "")
+        finally:
+            form_rendered.disconnect(receiver)
+
+        self.assertEquals(len(received), 1)
+        self.assertIs(received[0][0], form)
+        stats = received[0][1]
+        self.assertEquals(
+            (stats.fields, stats.tags, stats.matcher_evaluations, stats.choices),
+            (2, 2, 3, 2))
+        self.assertTrue(stats.gather_time >= 0 and stats.assign_time >= 0 and stats.render_time >= 0)
+
+    def test_form_using(self):
+        """
+        A form bound to a class at compile time.
+        """
+        tpl = Template(
+            "{% load forms %}{% form form using \"formtags.tests.SimpleForm\" %}"
+            "{% field %}{{ field.name }},{% endfield %}"
+            "{% field \"text*\" %}{{ field.name }};{% endfield %}"
+            "{% endform %}")
+
+        self.assertEquals(
+            _strip(tpl.render(Context({'form': SimpleForm()}))),
+            "numberfield,numberfield2,textfield;textfield2;")
+
+        # Other forms fall back to normal assignment
+        self.assertEquals(
+            _strip(tpl.render(Context({'form': ChoiceForm2()}))),
+            "choicefield,textfield;")
+
+        # Matching errors are reported at compile time
+        with self.assertRaises(FormTagError):
+            Template(
+                "{% load forms %}{% form form using \"formtags.tests.SimpleForm\" %}"
+                "{% field \"nosuchfield\" %}{% endfield %}{% field %}{% endfield %}"
+                "{% endform %}")
+
+        with self.assertRaises(FormTagError):
+            Template(
+                "{% load forms %}{% form form using \"formtags.tests.SimpleForm\" %}"
+                "{% field \"textfield\" %}{% endfield %}"
+                "{% endform %}")
+
+        # Field tags must be statically known
+        with self.assertRaises(FormTagError):
+            Template(
+                "{% load forms %}{% form form using \"formtags.tests.SimpleForm\" %}"
+                "{% if x %}{% field %}{% endfield %}{% endif %}"
+                "{% endform %}")
+
+        with self.assertRaises(FormTagError):
+            Template(
+                "{% load forms %}{% form form using \"formtags.tests.NoSuchForm\" %}"
+                "{% endform %}")
+
     def test_if_field(self):
         """
         Test the if_field tag.
@@ -362,16 +1035,433 @@ class FormtagTests(unittest.TestCase):
             catchall
             """)
 
-    def __test(self, form, template, expected):
+    def test_plan_cache(self):
+        """
+        A compiled template reuses its field assignment plan, but
+        falls back to full assignment when the visible fields change.
+        """
+        tpl = Template(
+            "{% load forms %}{% form form %}"
+            "{% field %}{{ field.name }},{% endfield %}"
+            "{% field \"text*\" %}{{ field.name }};{% endfield %}"
+            "{% endform %}")
+
+        for i in range(2):
+            self.assertEquals(
+                _strip(tpl.render(Context({'form': SimpleForm()}))),
+                "numberfield,numberfield2,textfield;textfield2;"
+                )
+
+        form = SimpleForm()
+        del form.fields['numberfield']
+        self.assertEquals(
+            _strip(tpl.render(Context({'form': form}))),
+            "numberfield2,textfield;textfield2;"
+            )
+
+        form = SimpleForm()
+        del form.fields['textfield']
+        del form.fields['textfield2']
+        with self.assertRaises(FormTagError):
+            tpl.render(Context({'form': form}))
+
+    def test_dynamic_matcher(self):
+        """
+        Matchers resolved from context variables are not cached.
+        """
+        tpl = Template(
+            "{% load forms %}{% form form %}"
+            "{% field matcher %}{{ field.name }},{% endfield %}"
+            "{% field %}{% endfield %}"
+            "{% endform %}")
+
+        self.assertEquals(
+            _strip(tpl.render(Context({'form': SimpleForm(), 'matcher': 'text*'}))),
+            "textfield,textfield2,"
+            )
+        self.assertEquals(
+            _strip(tpl.render(Context({'form': SimpleForm(), 'matcher': '*2'}))),
+            "textfield2,numberfield2,"
+            )
+
+    def test_gathering_pass(self):
+        """
+        Markup outside the field tags is rendered only once, and
+        field tags inside conditional and scoping tags are gathered
+        correctly.
+        """
+        counter = _Counter()
+        self.__test(
+            SimpleForm(),
+            # Template:
+            """
+            {{ counter.hit }}
+            {% if flag %}{% field "textfield" %}T,{% endfield %}
+            {% else %}{% field "numberfield" %}N,{% endfield %}{% endif %}
+            {% with prefix="number" %}{% field "*2" %}{{ prefix }}{{ field.name }},{% endfield %}{% endwith %}
+            {% for x in "ab" %}{% field "textfield?" %}{{ x }}{% endfield %}{% endfor %}
+            {% field %}{{ counter.hit }}{{ field.name }},{% endfield %}
+            """,
+            # Expected:
+            """
+            1
+            T,
+            numbertextfield2,numbernumberfield2,
+            2numberfield,
+            """,
+            counter=counter, flag=True)
+        self.assertEquals(counter.count, 2)
+
+    def test_exception_annotation(self):
+        """
+        Exceptions raised inside streamed tags point at the tag in the
+        template debug information.
+        """
+        engine = Engine(debug=True, libraries={'forms': 'formtags.templatetags.forms'})
+        tpl = engine.from_string(
+            '{% load forms %}{% form form %}{% field "textfield" %}\n'
+            '{% field_choices %}{% endfield_choices %}{% endfield %}'
+            '{% field %}{% endfield %}{% endform %}')
+
+        with self.assertRaises(AttributeError) as cm:
+            tpl.render(Context({'form': SimpleForm()}))
+        self.assertEquals(cm.exception.template_debug['during'], '{% field_choices %}')
+        self.assertEquals(cm.exception.template_debug['line'], 2)
+
+    def test_included_fields(self):
+        """
+        Field tags in included templates and block overrides are gathered.
+        """
+        engine = Engine(
+            loaders=[('django.template.loaders.locmem.Loader', {
+                'inc.html': '{% load forms %}{% field "textfield" %}T={{ field.name }};{% endfield %}',
+                'base.html': '{% load forms %}{% form form %}{% block extra %}{% endblock %}'
+                             '{% field %}{{ field.name }};{% endfield %}{% endform %}',
+                'child.html': '{% extends "base.html" %}{% load forms %}'
+                              '{% block extra %}{% field "numberfield" %}N={{ field.name }};{% endfield %}{% endblock %}',
+                'main.html': '{% load forms %}{% form form %}{% include "inc.html" %}'
+                             '{% field %}{{ field.name }};{% endfield %}{% endform %}',
+                'nested.html': '{% load forms %}{% form form %}'
+                               '{% field "numberfield" %}N[{% include "inc.html" %}]{% endfield %}'
+                               '{% field %}{{ field.name }};{% endfield %}{% endform %}',
+                })],
+            libraries={'forms': 'formtags.templatetags.forms'})
+
+        context = Context({'form': SimpleForm()})
+        self.assertEquals(
+            _strip(engine.get_template('child.html').render(context)),
+            'N=numberfield;textfield;textfield2;numberfield2;')
+        self.assertEquals(
+            _strip(engine.get_template('main.html').render(context)),
+            'T=textfield;textfield2;numberfield;numberfield2;')
+        self.assertEquals(
+            _strip(engine.get_template('nested.html').render(context)),
+            'N[T=textfield;]textfield2;numberfield2;')
+
+    def test_nested_form_rendering(self):
+        """
+        Nested forms are not rendered during the gathering pass of the
+        enclosing form, so each form body is rendered only once.
+        """
+        counter = _Counter()
+        self.__test(
+            SimpleForm(),
+            # Template:
+            """
+            {% for x in "a" %}
+            {% field "textfield" %}{{ field.name }},{% endfield %}
+            {% form inner %}{% for y in "b" %}{% field "numberfield" %}{% endfield %}
+            {% form inner2 %}{{ counter.hit }}:{% field %}{{ field.name }},{% endfield %}{% endform %}
+            {% endfor %}{% field %}{% endfield %}{% endform %}
+            {% endfor %}
+            {% field %}{{ field.name }};{% endfield %}
+            """,
+            # Expected:
+            """
+            textfield,
+            1:textfield,textfield2,numberfield,numberfield2,
+            textfield2;numberfield;numberfield2;
+            """,
+            counter=counter, inner=SimpleForm(), inner2=SimpleForm())
+        self.assertEquals(counter.count, 1)
+
+    def test_large_form(self):
+        """
+        Wildcard and positional matchers on a form with many fields.
+        """
+        form = forms.Form()
+        for i in range(500):
+            form.fields['attr_{0}_{1}'.format(i, 'x' if i % 2 else 'y')] = forms.CharField()
+
+        self.__test(
+            form,
+            # Template:
+            """
+            {% field "attr_1*" %}{% endfield %}
+            {% field "<attr_5_x" %}{{ field.name }},{% endfield %}
+            {% field "*_y" %}{% endfield %}
+            {% field ">=attr_498_y" %}{{ field.name }},{% endfield %}
+            {% field %}{{ field.name }},{% endfield %}
+            """,
+            # Expected:
+            """
+            attr_3_x,
+            attr_499_x,
+            """ + ''.join(
+                'attr_{0}_x,'.format(i) for i in range(5, 498, 2)
+                if not str(i).startswith('1')
+                ))
+
+    def test_matcher_parsing(self):
+        """
+        Literal matchers are parsed at compile time and runtime matcher
+        strings are parsed only once.
+        """
+        tpl = Template('{% load forms %}{% field "a*" %}{% endfield %}{% field "<b" %}{% endfield %}')
+        nodes = tpl.nodelist.get_nodes_by_type(FieldNode)
+        self.assertEquals(
+            [repr(n) for n in nodes],
+            ['<Field node: NameMatcher(a*)>', '<Field node: RelativeMatcher(<b)>'])
+
+        self.assertIs(_get_matcher('x*?'), _get_matcher('x*?'))
+        self.assertIsInstance(_get_matcher('x*?'), OptionalNameMatcher)
+        self.assertIsInstance(_get_matcher(''), AnyMatcher)
+
+        # Matchers are slotted and carry a precomputed precedence
+        for m in ('a', 'a?', '*a', 'a*', 'a*?', '<a', '>=a', ''):
+            self.assertFalse(hasattr(_get_matcher(m), '__dict__'))
+        self.assertEquals(
+            [_get_matcher(m).precedence for m in ('a', 'a?', '*a', 'a*', '*a?', 'a*?', '<a', '>a', '')],
+            [0, 2, 10, 11, 12, 13, 50, 60, 99])
+
+    def test_attribute_matchers(self):
+        """
+        Fields can be matched by widget class, form field class and flags.
+        Attribute matchers have lower precedence than name matchers.
+        """
+        self.__test(
+            AttributeForm(),
+            # Template:
+            """
+            {% field "widget:Textarea" %}AREA:{{ field.name }},{% endfield %}
+            {% field "type:IntegerField" %}INT:{{ field.name }},{% endfield %}
+            {% field "widget:Select?" %}ERROR{% endfield %}
+            {% field "is:hidden-initial" %}HI:{{ field.name }},{% endfield %}
+            {% field "is:required" %}REQ:{{ field.name }},{% endfield %}
+            {% field "widget:CheckboxInput" %}CB:{{ field.name }},{% endfield %}
+            {% field "count" %}NAME:{{ field.name }},{% endfield %}
+            """,
+            # Expected
+            """
+            AREA:text,
+            INT:number,
+            HI:date,
+            REQ:title,
+            CB:flag,
+            NAME:count,
+            """)
+
+        # Missing non-optional matches are an error
+        with self.assertRaises(FormTagError):
+            self.__test(
+                AttributeForm(),
+                """{% field "widget:Select" %}{% endfield %}{% field %}{% endfield %}""",
+                "")
+
+        with self.assertRaises(FormTagError):
+            Template('{% load forms %}{% field "is:unknown" %}{% endfield %}')
+
+        self.assertEquals(
+            [_get_matcher(m).precedence for m in ('widget:A', 'type:A', 'is:required', 'widget:A?')],
+            [20, 21, 30, 22])
+
+    def test_pattern_matchers(self):
+        """
+        Glob and regular expression matchers. Glob matchers have
+        precedence over regular expressions, and both over attribute
+        matchers.
+        """
+        self.__test(
+            PatternForm(),
+            # Template:
+            """
+            {% field "re:item_[0-9]+_qty" %}RE:{{ field.name }},{% endfield %}
+            {% field "address_*_line" %}GLOB:{{ field.name }},{% endfield %}
+            {% field "*_1_*" %}GLOB1:{{ field.name }},{% endfield %}
+            {% field "re?:(item|address)_.*" %}ERROR{% endfield %}
+            {% field "x*y?" %}ERROR{% endfield %}
+            {% field %}{{ field.name }},{% endfield %}
+            """,
+            # Expected
+            """
+            RE:item_2_qty,
+            GLOB:address_1_line,GLOB:address_2_line,
+            GLOB1:item_1_qty,GLOB1:item_1_name,GLOB1:address_1_zip,
+            title,
+            """)
+
+        # Missing non-optional matches are an error
+        with self.assertRaises(FormTagError):
+            self.__test(
+                PatternForm(),
+                """{% field "re:x.*" %}{% endfield %}{% field %}{% endfield %}""",
+                "")
+
+        with self.assertRaises(FormTagError):
+            Template('{% load forms %}{% field "re:(" %}{% endfield %}')
+
+        # ? matches a single character, a trailing ? marks the matcher optional
+        self.__test(
+            PatternForm(),
+            # Template:
+            """
+            {% field "item_?_qty" %}A:{{ field.name }},{% endfield %}
+            {% field "address_?_l*" %}B:{{ field.name }},{% endfield %}
+            {% field "address_1_zi??" %}C:{{ field.name }},{% endfield %}
+            {% field "address_*_line?" %}ERROR{% endfield %}
+            {% field "tit??" %}ERROR{% endfield %}
+            {% field %}{{ field.name }},{% endfield %}
+            """,
+            # Expected
+            """
+            A:item_1_qty,A:item_2_qty,
+            B:address_1_line,B:address_2_line,
+            C:address_1_zip,
+            title,item_1_name,
+            """)
+
+        self.assertEquals(
+            [_get_matcher(m).precedence for m in ('a*b', 're:a', 'a*b?', 're?:a', '*a*', 'a?b', 'a??')],
+            [14, 15, 16, 17, 14, 14, 16])
+
+    def test_combined_patterns(self):
+        """
+        Pattern matchers that cannot be combined into one expression are
+        matched one by one.
+        """
+        self.__test(
+            PatternForm(),
+            # Template:
+            """
+            {% field "re:(?P<n>item)_1_.*" %}A:{{ field.name }},{% endfield %}
+            {% field "re:(?P<n>item)_.*" %}B:{{ field.name }},{% endfield %}
+            {% field %}{{ field.name }},{% endfield %}
+            """,
+            # Expected
+            """
+            A:item_1_qty,A:item_1_name,
+            B:item_2_qty,
+            title,address_1_line,address_1_zip,address_2_line,
+            """)
+
+        # Expressions with groups are combined, the ones with backreferences
+        # are not.
+        self.__test(
+            PatternForm(),
+            # Template:
+            """
+            {% field "re:(a)ddress_(1)_.*" %}C:{{ field.name }},{% endfield %}
+            {% field "re:(?P<x>a)d(?P=x)?dress_.*" %}D:{{ field.name }},{% endfield %}
+            {% field "re:(i)tem_.*" %}E:{{ field.name }},{% endfield %}
+            {% field %}{{ field.name }},{% endfield %}
+            """,
+            # Expected
+            """
+            C:address_1_line,C:address_1_zip,
+            D:address_2_line,
+            E:item_1_qty,E:item_1_name,E:item_2_qty,
+            title,
+            """)
+
+    def test_attribute_matcher_plans(self):
+        """
+        Cached assignment plans take the widgets of the form instance
+        into account.
+        """
+        tpl = Template("""{% load forms %}{% form form %}
+            {% field "widget:Textarea?" %}AREA:{{ field.name }},{% endfield %}
+            {% field %}{{ field.name }},{% endfield %}
+            {% endform %}""")
+
+        class AlteredForm(AttributeForm):
+            def __init__(self, area=False):
+                super(AlteredForm, self).__init__()
+                if area:
+                    self.fields['title'].widget = forms.Textarea()
+
+        render = lambda form: _strip(tpl.render(Context({'form': form})))
+        self.assertEquals(render(AlteredForm()), 'AREA:text,title,count,number,date,flag,')
+        self.assertEquals(render(AlteredForm(area=True)), 'AREA:title,AREA:text,count,number,date,flag,')
+        self.assertEquals(render(AlteredForm()), 'AREA:text,title,count,number,date,flag,')
+
+    def __test(self, form, template, expected, **kwargs):
         return self.assertEquals(
-            _strip(_render(''.join((
+            _strip(self._render(''.join((
                 "{% load forms %}{% form form %}",
                 template,
                 '{% endform %}')),
-                form=form)),
+                form=form, **kwargs)),
             _strip(expected)
             )
 
+    def _render(self, template, **kwargs):
+        return _render(template, **kwargs)
+
+@unittest.skipIf(jinja2 is None, "Jinja2 is not installed")
+class JinjaFormtagTests(FormtagTests):
+    """
+    Run the template scenarios of the Django tag tests with the Jinja2
+    extension.
+    """
+
+    # Tests of features specific to the Django tag library
+    django_only = set([
+        'test_gathering_pass',
+        'test_plan_cache',
+        'test_dynamic_matcher',
+        'test_matcher_parsing',
+        'test_stream_template',
+        'test_formset',
+        'test_field_cache',
+        'test_form_cache',
+        'test_form_using',
+        'test_form_rendered_signal',
+        'test_field_switch',
+        'test_attribute_matcher_plans',
+        'test_choice_prefetch',
+        'test_nested_form_rendering',
+        'test_render_form_fragment',
+        'test_render_form_patches',
+        'test_render_form_map_data',
+        'test_layout',
+        'test_fast_widget_parity',
+        'test_included_fields',
+        'test_exception_annotation',
+        ])
+
+    def setUp(self):
+        if self._testMethodName in self.django_only:
+            self.skipTest("Django tag library only")
+
+    def test_jinja_plan_cache(self):
+        """
+        Assignment plans are shared by all form tags of an environment
+        and bounded, no matter how often templates are compiled.
+        """
+        env = jinja2.Environment(extensions=['formtags.jinja.FormtagsExtension'])
+        source = '{% form form %}{% field "textfield" %}{% endfield %}{% field %}{% endfield %}{% endform %}'
+        for i in range(50):
+            env.from_string(source).render(form=SimpleForm())
+        self.assertEquals(len(env.extensions['formtags.jinja.FormtagsExtension']._plans), 1)
+
+    def _render(self, template, **kwargs):
+        template = template.replace('{% load forms %}', '')
+        template = re.sub(r'\|widget_name:("[^"]*")', r'|widget_name(\1)', template)
+        env = jinja2.Environment(
+            extensions=['formtags.jinja.FormtagsExtension'],
+            autoescape=True)
+        return env.from_string(template).render(**kwargs)
+
 class SimpleForm(forms.Form):
     textfield = forms.CharField()
     textfield2 = forms.CharField()
@@ -386,6 +1476,14 @@ class ChoiceForm(forms.Form):
         ('C', 'Choice 3'),
         ))
 
+class MultiChoiceForm(forms.Form):
+    choicefield = forms.MultipleChoiceField(choices=(
+        ('A', 'Choice 1'),
+        ('AB', 'Choice 2'),
+        ('B', 'Choice 3'),
+        ('1', 'Choice 4'),
+        ))
+
 class ChoiceForm2(forms.Form):
     textfield = forms.CharField()
     choicefield = forms.ChoiceField(choices=(
@@ -393,6 +1491,54 @@ class ChoiceForm2(forms.Form):
         ('B', 'Choice 2'),
         ))
 
+class AttributeForm(forms.Form):
+    title = forms.CharField()
+    text = forms.CharField(widget=forms.Textarea(), required=False)
+    count = forms.IntegerField(required=False)
+    number = forms.IntegerField(required=False)
+    date = forms.DateField(show_hidden_initial=True)
+    flag = forms.BooleanField(required=False)
+
+class PatternForm(forms.Form):
+    title = forms.CharField()
+    item_1_qty = forms.IntegerField()
+    item_1_name = forms.CharField()
+    item_2_qty = forms.IntegerField()
+    address_1_line = forms.CharField()
+    address_1_zip = forms.CharField()
+    address_2_line = forms.CharField()
+
+class _CustomInput(forms.TextInput):
+    pass
+
+class ParityForm(forms.Form):
+    text = forms.CharField(widget=forms.TextInput(attrs={
+        'placeholder': 'Say "hi" & <bye>', 'autofocus': True, 'hidden': False, 'size': 10}))
+    text2 = forms.CharField(show_hidden_initial=True, required=False, max_length=5)
+    number = forms.DecimalField(localize=True, min_value=0, initial=1234.5)
+    email = forms.EmailField(disabled=True, initial='x@example.com')
+    url = forms.URLField(required=False)
+    password = forms.CharField(widget=forms.PasswordInput(render_value=True))
+    date = forms.DateField(widget=forms.DateInput(format='%d.%m.%Y'), initial=datetime.date(2020, 1, 2))
+    stamp = forms.DateTimeField(required=False)
+    time = forms.TimeField(required=False, initial=datetime.time(3, 4))
+    check = forms.BooleanField(required=False, initial=True)
+    area = forms.CharField(widget=forms.Textarea(attrs={'rows': 3}), initial='<i>x</i>')
+    select = forms.TypedChoiceField(coerce=int, choices=[(1, 1), (2, 'Two'), (1000, 1000)], initial=2)
+    grouped = forms.ChoiceField(choices=[
+        ('', '---'), ('G<1>', [('a', 'A & B'), ('b', 'B')]), ('c', 'C')])
+    null = forms.NullBooleanField()
+    multiple = forms.MultipleChoiceField(choices=[('1', 'One'), ('2', 'Two'), ('3', 'Three')])
+    lazy = forms.ChoiceField(choices=[('x', gettext_lazy('Lazy <label>'))])
+    radio = forms.ChoiceField(widget=forms.RadioSelect, choices=[('1', 'One')])
+    custom = forms.CharField(widget=_CustomInput)
+    overridden = forms.CharField(widget=forms.TextInput)
+    hidden = forms.IntegerField(widget=forms.HiddenInput)
+
+    def __init__(self, *args, **kwargs):
+        super(ParityForm, self).__init__(*args, **kwargs)
+        self.fields['overridden'].widget.template_name = 'django/forms/widgets/input.html'
+
 class GroupedChoiceForm(forms.Form):
     choicefield = forms.ChoiceField(choices=(
         ('0', 'C0'),
@@ -406,6 +1552,14 @@ class GroupedChoiceForm(forms.Form):
         )),
         ))
 
+class _Counter(object):
+    def __init__(self):
+        self.count = 0
+
+    def hit(self):
+        self.count += 1
+        return self.count
+
 def _strip(text):
     return re.sub(r'\s', '', text)
 
@@ -5,6 +5,7 @@ setup(
     version='1.4',
 
     packages=find_packages(),
+    package_data={'formtags': ['templates/formtags/*.html']},
 
     install_requires=['django'],
 